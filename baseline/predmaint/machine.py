@@ -0,0 +1,209 @@
+import threading
+from datetime import datetime as dt
+from time import sleep, monotonic
+
+import numpy as np
+
+
+class SensorBuffer:
+    """ a fixed-size ring buffer of sensor readings
+
+    Readings are stored in two preallocated NumPy arrays, the times
+    as datetime64[ns] and the values as float64. Appending a reading
+    is O(1) and never copies existing data.
+
+    Every reading is written twice, at position i and i + size. This
+    way the latest N readings are always a contiguous slice of the
+    arrays, so that latest() copies them in one step.
+
+    Args:
+        size (int): the maximum number of readings kept, defaults to 1000
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.times = np.zeros(2 * size, dtype='datetime64[ns]')
+        self.values = np.zeros(2 * size, dtype='float64')
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, value, time=None):
+        """ add a single reading
+
+        Args:
+            value (float): the sensor value
+            time (datetime|np.datetime64): the time of the reading,
+               defaults to now
+        """
+        time = np.datetime64(time or dt.now(), 'ns')
+        with self._lock:
+            i = self.count % self.size
+            self.times[i] = self.times[i + self.size] = time
+            self.values[i] = self.values[i + self.size] = value
+            self.count += 1
+
+    def extend(self, values, times):
+        """ add a block of readings
+
+        This is faster than calling append() for every reading, use it
+        for high sample rates.
+
+        Args:
+            values (np.ndarray): the sensor values
+            times (np.ndarray): the times of the readings, datetime64
+        """
+        values = np.asarray(values, dtype='float64')[-self.size:]
+        times = np.asarray(times, dtype='datetime64[ns]')[-self.size:]
+        with self._lock:
+            # positions in the first half, wrapping around
+            pos = (self.count + np.arange(len(values))) % self.size
+            self.times[pos] = self.times[pos + self.size] = times
+            self.values[pos] = self.values[pos + self.size] = values
+            self.count += len(values)
+
+    def latest(self, records, since=None):
+        """ return the latest readings, oldest first
+
+        The arrays returned are copies, taken while holding the lock,
+        i.e. readings appended meanwhile never change them.
+
+        Args:
+            records (int): the number of readings
+            since (np.datetime64): if given, only return readings
+               after this time
+
+        Returns:
+            (times, values) tuple of np.ndarray
+        """
+        with self._lock:
+            records = max(0, min(records, self.size, self.count))
+            end = self.count % self.size + self.size
+            start = end - records
+            if since is not None:
+                # times are in ascending order
+                start += np.searchsorted(self.times[start:end], since, side='right')
+            return (self.times[start:end].copy(),
+                    self.values[start:end].copy())
+
+
+class Machine:
+    """ a simulated machine with a sensor
+
+    The sensor reports gamma-distributed values at the given rate,
+    into a SensorBuffer. To support high sample rates, the sensor
+    generates readings in blocks of tick seconds.
+
+    Args:
+        shape (float): the gamma distribution's shape
+        scale (float): the gamma distribution's scale
+        size (int): the number of readings kept by the sensor
+        rate (float): the number of readings per second
+        tick (float): the seconds between blocks of readings
+
+    Usage:
+        machine = Machine(shape=1., scale=.1)
+        machine.start()
+        times, values = machine.buffer.latest(100)
+    """
+    def __init__(self, shape=1., scale=.1, size=1000, rate=10, tick=.1):
+        self.shape = shape
+        self.scale = scale
+        self.rate = rate
+        self.tick = tick
+        self.buffer = SensorBuffer(size)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sensor(self):
+        rnd = np.random.default_rng()
+        step = np.timedelta64(int(1e9 / self.rate), 'ns')
+        last = np.datetime64(dt.now(), 'ns')
+        start = monotonic()
+        while not self._stop.is_set():
+            now = np.datetime64(dt.now(), 'ns')
+            n = int((now - last) / step)
+            if n > 0:
+                times = last + step * np.arange(1, n + 1)
+                self.buffer.extend(rnd.gamma(self.shape, self.scale, n), times)
+                last = times[-1]
+            # keep a steady tick regardless of the time taken above
+            sleep(self.tick - (monotonic() - start) % self.tick)
+
+    def start(self):
+        # we use a Thread to run the machine "in the background"
+        self._thread = threading.Thread(target=self.sensor, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+def parse_time(value):
+    """ parse a time given as nanoseconds since epoch or ISO 8601
+
+    Args:
+        value (str): the time
+
+    Returns:
+        np.datetime64[ns]
+
+    Raises:
+        ValueError if the value is not a time
+        OverflowError if the time is not within the datetime64[ns] range,
+        i.e. years 1678 to 2261
+    """
+    if value.isdigit():
+        return np.datetime64(int(value), 'ns')
+    parsed = np.datetime64(value)
+    # -- numpy silently wraps times outside the range when converting
+    time = parsed.astype('datetime64[ns]')
+    if time.astype(parsed.dtype) != parsed:
+        raise OverflowError(f'{value} is out of range')
+    return time
+
+
+def create_app(machines):
+    """ create the machine API
+
+    * /query/<records> reports the latest N sensor values of the
+      first machine
+    * /<machine>/query/<records> reports the latest N sensor values
+      of the given machine
+    * ?since=<time> only reports the values after this time, given as
+      nanoseconds since epoch or ISO 8601
+
+    Values are returned as json, {'values': [(dt, value), ...]}. If
+    the request's Accept header prefers util.BINARY_MIMETYPE, the
+    values are returned in binary format, see util.encode_values().
+
+    Args:
+        machines (Machine|dict): a machine, or a dict of name => Machine
+
+    Returns:
+        the Flask app
+    """
+    from flask import Flask, Response, abort, request
+    from util import BINARY_MIMETYPE, encode_values
+
+    machines = machines if isinstance(machines, dict) else {'0': machines}
+    default = next(iter(machines))
+    app = Flask("factory")
+
+    @app.route("/query/<int:records>")
+    @app.route("/<machine>/query/<int:records>")
+    def data(records, machine=default):
+        if machine not in machines:
+            abort(404)
+        since = request.args.get('since')
+        if since:
+            try:
+                since = parse_time(since)
+            except (ValueError, OverflowError, OSError):
+                abort(400, f'invalid since={since}, expected nanoseconds since epoch or ISO 8601')
+        times, values = machines[machine].buffer.latest(records, since=since)
+        if request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE:
+            return Response(encode_values(times, values), mimetype=BINARY_MIMETYPE)
+        return {'values': list(zip(np.datetime_as_string(times, unit='us').tolist(),
+                                   values.tolist()))}
+
+    return app
@@ -0,0 +1,115 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from util import AlertLog, fix, load_model, read_data
+
+# the model of a worker process, see BatchScorer
+_worker_model = None
+
+def read_windows(machines, records=100, **kwargs):
+    """ read the latest N records of many machines
+
+    Args:
+        machines (list): the machine names
+        records (int): the number of records per machine, defaults to 100
+        kwargs: passed to read_data()
+
+    Returns:
+        dict of machine => pd.DataFrame, see read_data()
+    """
+    return {machine: read_data(records, machine=machine, **kwargs)
+            for machine in machines}
+
+class BatchScorer:
+    """ score the windows of many machines at once
+
+    Instead of calling model.predict() once per machine, the windows
+    of all machines are concatenated into one feature matrix and scored
+    in a single call. The predictions are then split by machine. This
+    avoids the model's per-call overhead, which dominates for small
+    windows.
+
+    Large batches can be scored by a pool of processes, in chunks of
+    chunk_size rows. Each worker process loads the model once. If the
+    model is given as a path, workers memory-map its arrays, sharing
+    the memory, see load_model().
+
+    Args:
+        model (str|estimator): the model, or the path of the model
+        n_jobs (int): the number of processes, defaults to None, that
+           is scoring in the current process
+        chunk_size (int): the number of rows per process, defaults to
+           100000. Batches smaller than this are always scored in the
+           current process
+
+    Usage:
+        scorer = BatchScorer('models/mymodel')
+        windows = read_windows(['m1', 'm2', 'm3'])
+        scored, alerts = scorer.score(windows)
+        # scored => dict of machine => df with columns value, time, alert
+        # alerts => dict of machine => AlertLog
+    """
+    def __init__(self, model, n_jobs=None, chunk_size=100000):
+        self.model_path = model if isinstance(model, str) else None
+        self.model = load_model(model) if isinstance(model, str) else model
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def score(self, windows, alerts=None):
+        """ predict outliers for the windows of many machines
+
+        Args:
+            windows (dict): machine => df with a value column and a
+               DatetimeIndex, see read_windows()
+            alerts (dict): machine => AlertLog, the alerts seen so far.
+               Missing machines are added
+
+        Returns:
+            (scored, alerts) tuple of dicts, machine => df with the
+            columns value, time, alert, and machine => AlertLog
+        """
+        alerts = alerts if alerts is not None else {}
+        machines = [m for m in windows if len(windows[m])]
+        if not machines:
+            return {}, alerts
+        X = np.concatenate([fix(windows[m]['value']) for m in machines])
+        y_hat = self.predict(X)
+        bounds = np.cumsum([0] + [len(windows[m]) for m in machines])
+        scored = {}
+        for machine, start, end in zip(machines, bounds[:-1], bounds[1:]):
+            df = windows[machine].copy()
+            df['time'] = df.index
+            df['alert'] = y_hat[start:end] == -1
+            scored[machine] = df
+            alerts.setdefault(machine, AlertLog()).update(df)
+        return scored, alerts
+
+    def predict(self, X):
+        """ predict X, in chunks by a process pool if n_jobs is set """
+        if not self.n_jobs or len(X) <= self.chunk_size:
+            return self.model.predict(X)
+        chunks = [X[i:i + self.chunk_size] for i in range(0, len(X), self.chunk_size)]
+        return np.concatenate(list(self.pool.map(_predict, chunks)))
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            model = self.model_path or self.model
+            self._pool = ProcessPoolExecutor(max_workers=self.n_jobs,
+                                             initializer=_init_worker,
+                                             initargs=(model,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = load_model(model, mmap_mode='r') if isinstance(model, str) else model
+
+def _predict(X):
+    return _worker_model.predict(X)
@@ -1,13 +1,38 @@
 import os
+import struct
+import tempfile
+
+import numpy as np
 import pandas as pd
 import requests
 import joblib
 
-def read_data(records=100):
+#: the machine API
+MACHINE_API = 'http://localhost:5000'
+#: the binary format of sensor values, see encode_values()
+BINARY_MIMETYPE = 'application/x-sensor-values'
+BINARY_HEADER = struct.Struct('<4s4xQ')
+BINARY_MAGIC = b'SNSR'
+
+# reuse connections (keep-alive) for all requests to the machine API
+session = requests.Session()
+# the latest records read per (api, machine, records), see read_data()
+_windows = {}
+# the models loaded per (path, mtime, size, mmap_mode), see load_model()
+_models = {}
+
+def read_data(records=100, binary=False, machine=None, incremental=True):
     """ read latest N records from machine API
     
     Args:
         records (int): the number of records, defaults to 100
+        binary (bool): if True, request the binary format instead of
+           json, see encode_values(). Defaults to False
+        machine (str): the machine to query, defaults to the machine
+           API's default machine
+        incremental (bool): if True, keep the records read and on the
+           next call only request the records added since, using the
+           machine API's since= parameter. Defaults to True
         
     Returns:
         df (pd.DataFrame): the dataframe with columns
@@ -15,14 +40,76 @@ def read_data(records=100):
            dt: datetime of the value
            value: a sensor value
     """
-    resp = requests.get(f'http://localhost:5000/query/{records}')
-    data = resp.json()
+    key = (MACHINE_API, machine, records)
+    cached = _windows.get(key) if incremental else None
+    since = cached.index[-1] if cached is not None and len(cached) else None
+    df = _query(records, binary=binary, machine=machine, since=since)
+    if since is not None:
+        # the json format has microsecond precision, drop any overlap
+        df = pd.concat([cached, df[df.index > since]]).iloc[-records:]
+    if incremental:
+        _windows[key] = df
+        # callers may modify the dataframe, keep ours as is
+        df = df.copy()
+    return df
+
+def _query(records, binary=False, machine=None, since=None):
+    # query the machine API
+    path = f'{machine}/query/{records}' if machine else f'query/{records}'
+    accept = f'{BINARY_MIMETYPE}, application/json;q=0.5' if binary else 'application/json'
+    params = {'since': since.value} if since is not None else None
+    resp = session.get(f'{MACHINE_API}/{path}', headers={'Accept': accept}, params=params)
+    resp.raise_for_status()
+    if resp.headers.get('Content-Type', '').startswith(BINARY_MIMETYPE):
+        times, values = decode_values(resp.content)
+    else:
+        data = resp.json()
+        df = pd.DataFrame(data['values'], columns=['dt', 'value'])
+        times, values = pd.to_datetime(df['dt']).values, df['value'].to_numpy('float64')
+    return pd.DataFrame({'value': values},
+                        index=pd.DatetimeIndex(times, name='dt'))
+
+def encode_values(times, values):
+    """ encode sensor values in binary format
+    
+    The format is a 16-byte header followed by the raw arrays:
+
+        magic (4 bytes): b'SNSR'
+        padding (4 bytes)
+        n (uint64): the number of values
+        times (n * int64): nanoseconds since epoch
+        values (n * float64): the sensor values
+
+    All numbers are little-endian.
+
+    Args:
+        times (np.ndarray): the times of the values, datetime64
+        values (np.ndarray): the sensor values
+        
+    Returns:
+        bytes
+    """
+    times = np.asarray(times, dtype='datetime64[ns]').view('<i8')
+    values = np.asarray(values, dtype='<f8')
+    return BINARY_HEADER.pack(BINARY_MAGIC, len(values)) + times.tobytes() + values.tobytes()
 
-    df = pd.DataFrame({
-        'dt': pd.to_datetime([v[0] for v in data['values']]),
-        'value': [v[1] for v in data['values']],
-    })
-    return df.set_index('dt')
+def decode_values(data):
+    """ decode sensor values in binary format, see encode_values()
+    
+    Args:
+        data (bytes): the encoded values
+        
+    Returns:
+        (times, values) tuple of np.ndarray, times as datetime64[ns],
+        values as float64. The arrays are read-only views of data
+    """
+    magic, n = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError(f'not a binary sensor format, got {magic}')
+    offset = BINARY_HEADER.size
+    times = np.frombuffer(data, dtype='<i8', count=n, offset=offset).view('datetime64[ns]')
+    values = np.frombuffer(data, dtype='<f8', count=n, offset=offset + 8 * n)
+    return times, values
 
 def fix(series):
     """ fix the series to match the model API
@@ -35,29 +122,196 @@ def fix(series):
     """
     return series.values.reshape((-1, 1))
 
-def load_model(name):
+def load_model(name, mmap_mode=None, cache=True):
     """ load a model
     
+    Models are cached by path, modification time and size of the
+    file, that is a model is loaded from disk only once, or when the
+    file has changed. Note all callers get the same model instance.
+    
+    With mmap_mode='r' the model's numpy arrays are memory-mapped from
+    the file instead of being read into memory. This way processes
+    that load the same model share its memory. This requires the model
+    to be saved uncompressed, see save_model().
+    
     Args:
         name (str): the path/name of the model
+        mmap_mode (str): None, 'r', 'r+', 'w+' or 'c', see joblib.load
+        cache (bool): if False, always load from disk, defaults to True
         
     Returns:
         the model
     """
     name = name.replace('/', os.path.sep)
-    with open(name, 'rb') as fin:
-        model = joblib.load(fin)
+    stat = os.stat(name)
+    path = os.path.abspath(name)
+    key = (path, stat.st_mtime_ns, stat.st_size, mmap_mode)
+    if cache and key in _models:
+        return _models[key]
+    if mmap_mode:
+        # memory mapping requires a filename, not a file object
+        model = joblib.load(name, mmap_mode=mmap_mode)
+    else:
+        with open(name, 'rb') as fin:
+            model = joblib.load(fin)
+    if cache:
+        # forget previous versions of this file
+        for stale in [k for k in _models if k[0] == path]:
+            del _models[stale]
+        _models[key] = model
     return model
 
-def save_model(model, name):
+def save_model(model, name, compress=0):
     """ save a model
     
+    The model is written to a temporary file, which then replaces the
+    file. This way processes that have memory-mapped the previous
+    version keep reading it, and reload the new version on their next
+    load_model().
+
     Args:
         name (str): the path/name of the model
+        compress (int|bool|str): the joblib compression, 0-9 or a method
+           such as 'lz4', see joblib.dump. Defaults to 0, uncompressed,
+           which is required for load_model(..., mmap_mode='r')
         
     Returns:
         None
     """
     name = name.replace('/', os.path.sep)
-    with open(name, 'wb') as fout:
-        joblib.dump(model, fout)
\ No newline at end of file
+    # in the same directory, os.replace() is atomic on the same filesystem
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(name) or '.',
+                                    prefix='.{}.'.format(os.path.basename(name)))
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            joblib.dump(model, fout, compress=compress)
+        # mkstemp creates the file as private, keep the mode of the previous version
+        os.chmod(tmp_name, os.stat(name).st_mode & 0o777 if os.path.exists(name) else 0o644)
+        os.replace(tmp_name, name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+def get_report_data(model, alerts=None, records=100, **kwargs):
+    """ read the latest records and predict outliers
+    
+    Args:
+        model (estimator): the model, predicting -1 for outliers
+        alerts (AlertLog): the alerts seen so far, defaults to a new AlertLog
+        records (int): the number of records, defaults to 100
+        kwargs: passed to read_data()
+        
+    Returns:
+        (df, alerts) tuple of the dataframe with columns value, time, alert,
+        and the alerts updated from df
+    """
+    df = read_data(records, **kwargs)
+    df['time'] = df.index
+    df['alert'] = model.predict(fix(df['value'])) == -1
+    alerts = alerts if alerts is not None else AlertLog()
+    alerts.update(df)
+    return df, alerts
+
+def calculate_expected_distribution(model, df):
+    """ predict outliers in the training data
+    
+    Args:
+        model (estimator): the model, predicting -1 for outliers
+        df (pd.DataFrame): the training data, with a value column
+        
+    Returns:
+        the distribution of alerts, as pd.Series of True/False => fraction
+    """
+    y_hat = model.predict(fix(df['value']))
+    df['alert'] = y_hat == -1
+    return df['alert'].value_counts(normalize=True)
+
+class AlertLog:
+    """ a bounded, time-indexed log of alerts
+    
+    Keeps the latest size alerts in a ring buffer. Alerts that have
+    already been logged, i.e. that are not newer than the latest alert,
+    are skipped. This way the same dataframe rows can be passed
+    repeatedly, as when polling the latest N records.
+    
+    Args:
+        size (int): the maximum number of alerts, defaults to 1000
+    
+    Usage:
+        alerts = AlertLog()
+        alerts.update(df)  # df with columns value, alert and a DatetimeIndex
+        alerts.to_frame()  # => dataframe with columns dt, value
+    """
+    def __init__(self, size=1000):
+        from machine import SensorBuffer
+        self.buffer = SensorBuffer(size)
+        self.last = None
+
+    def update(self, df):
+        alerts = df[df['alert']]
+        if self.last is not None:
+            alerts = alerts[alerts.index > self.last]
+        if len(alerts):
+            self.buffer.extend(alerts['value'].values, alerts.index.values)
+            self.last = alerts.index[-1]
+        return self
+
+    def to_frame(self):
+        times, values = self.buffer.latest(self.buffer.size)
+        return pd.DataFrame({'dt': times, 'value': values})
+
+    def __len__(self):
+        return min(self.buffer.count, self.buffer.size)
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+class DriftMonitor:
+    """ the distribution of alerts over a sliding window of predictions
+    
+    Keeps the latest window predictions in a ring buffer and a running
+    count of alerts, updated with every new prediction. Predictions that
+    have already been counted, i.e. that are not newer than the latest
+    prediction, are skipped.
+    
+    Args:
+        expected (pd.Series): the expected distribution, see
+           calculate_expected_distribution()
+        window (int): the number of predictions, defaults to 100
+    
+    Usage:
+        drift = DriftMonitor(expected)
+        drift.update(df)  # df with column alert and a DatetimeIndex
+        drift.drift()     # => dataframe with columns actual, expected
+    """
+    def __init__(self, expected, window=100):
+        self.expected = expected
+        self.window = window
+        self.alerts = np.zeros(window, dtype=bool)
+        self.count = 0
+        self.n_alerts = 0
+        self.last = None
+
+    def update(self, df):
+        if self.last is not None:
+            df = df[df.index > self.last]
+        flags = df['alert'].to_numpy(dtype=bool)[-self.window:]
+        if not len(flags):
+            return self
+        seq = self.count + np.arange(len(flags))
+        pos = seq % self.window
+        # remove the alerts evicted from the window, add the new ones
+        evicted = self.alerts[pos][seq >= self.window]
+        self.n_alerts += int(flags.sum()) - int(evicted.sum())
+        self.alerts[pos] = flags
+        self.count += len(flags)
+        self.last = df.index[-1]
+        return self
+
+    def drift(self):
+        n = min(self.count, self.window) or 1
+        actual = pd.Series({False: 1 - self.n_alerts / n, True: self.n_alerts / n})
+        return pd.DataFrame({
+             'actual': actual,
+             'expected': self.expected
+        })
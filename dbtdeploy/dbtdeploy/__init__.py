@@ -1,23 +1,95 @@
-def run(om=None, project=None, *args, **kwargs):
+from functools import lru_cache
+
+
+def run(om=None, project=None, *args, docs=False, timings=False, **kwargs):
+    """
+    run a dbt project
+
+    Usage:
+        $ om runtime script dbtdeploy run project=myproject [docs=yes] [timings=yes]
+
+    Args:
+        om (Omega): the omega instance
+        project (str): the project, i.e. its directory in the dbtdeploy package
+        docs (bool|str): if True, run dbt docs generate and store the report in
+           om.datasets as dbt/<project>/report.zip, see publish.zip_report().
+           Strings are True if yes, true or 1, e.g. docs=yes on the cli
+        timings (bool|str): if True, append the run's timings per model to
+           om.datasets as dbt/<project>/timings, see publish.publish_timings()
+        kwargs: passed to update_dbt_profile()
+
+    Returns:
+        the output of dbt
+    """
     from pathlib import Path
+    import shutil
     import subprocess
+    from dbtdeploy.publish import publish_report, publish_timings, zip_report
+    # the cli passes flags as strings, e.g. docs=no
+    docs, timings = (str(flag).lower() in ('1', 'true', 'yes') for flag in (docs, timings))
     dbt_dir = Path(__file__).parent
     project_dir = dbt_dir / project
-    cmd = f"dbt run -d --profiles-dir {dbt_dir} --project-dir {project_dir}"
-    update_dbt_profile(f"{dbt_dir}/profiles.yml", om=om, **kwargs)
-    results = subprocess.run(cmd, shell=True, check=True, capture_output=True)
-    return results.stdout.decode('utf-8')
+    target_dir = project_dir / 'target'
+    profiles_dir = update_dbt_profile(f"{dbt_dir}/profiles.yml", om=om, **kwargs)
+    try:
+        cmd = f"dbt run -d --profiles-dir {profiles_dir} --project-dir {project_dir}"
+        results = subprocess.run(cmd, shell=True, check=True, capture_output=True)
+        output = results.stdout.decode('utf-8')
+        if (docs or timings) and om is None:
+            import omegaml as om
+            om = om.setup()
+        if timings:
+            # dbt docs generate replaces run_results.json, publish the run's timings first
+            publish_timings(om, project, target_dir)
+        if docs:
+            cmd = f"dbt docs generate --profiles-dir {profiles_dir} --project-dir {project_dir}"
+            results = subprocess.run(cmd, shell=True, check=True, capture_output=True)
+            output += results.stdout.decode('utf-8')
+            publish_report(om, project, zip_report(target_dir))
+    finally:
+        # the rendered profile contains secrets, keep it no longer than needed
+        shutil.rmtree(profiles_dir, ignore_errors=True)
+    return output
 
 
-def update_dbt_profile(fn=None, mod=None, om=None, **vars):
+def update_dbt_profile(fn=None, mod=None, om=None, profiles_dir=None, **vars):
     """
-    update dbt profiles.yaml with omegaml defaults
+    render dbt profiles.yaml with omegaml defaults
+
+    The packaged profiles.yml is a template, it is never changed. It is rendered
+    using str.format(**vars), where vars are updated by om.defaults, into a new
+    directory in profiles_dir for every call, i.e. concurrent runs do not
+    interfere. The profile may contain secrets, so profiles_dir must be owned by
+    the current user and not be accessible by others, and the caller removes the
+    rendered directory once dbt has run. The rendered profile is cached in
+    memory, keyed by a hash of the template and the values of its placeholders.
 
     Usage:
         import omegaml as om
         mod = om.scripts.get('dbt/foo', install=True)
-        update_dbt_profile(mod=mod, om=om)
+        profiles_dir = update_dbt_profile(mod=mod, om=om)
+        # dbt run --profiles-dir $profiles_dir
+        shutil.rmtree(profiles_dir)
+
+    Args:
+        fn (str): the profiles.yml template, defaults to profiles.yml of mod
+        mod (module): the module, defaults to dbtdeploy
+        om (Omega): the omega instance, its defaults are used as values
+        profiles_dir (str): the root directory of rendered profiles, defaults
+           to a private temporary directory of the process, removed on exit
+        vars: the values of the placeholders
+
+    Returns:
+        the directory of the rendered profiles.yml, use as dbt --profiles-dir
+
+    Raises:
+        PermissionError if profiles_dir is not private to the current user
     """
+    import hashlib
+    import json
+    import os
+    import string
+    import tempfile
     from pathlib import Path
     default_fn = Path(getattr(mod, '__file__', __file__)).parent / 'profiles.yml'
     fn = Path(fn) if fn else default_fn
@@ -25,56 +97,160 @@ def update_dbt_profile(fn=None, mod=None, om=None, **vars):
         raise FileNotFoundError(f'dbt profiles.yml not found at {fn}')
     vars.update(**om.defaults) if om else None
     with open(fn, 'r') as f:
-        profiles = f.read()
-    with open(fn, 'w') as f:
-        profiles = profiles.format(**vars)
+        template = f.read()
+    # the rendered profile only depends on the template and the values of its placeholders
+    fields = {field.split('.')[0].split('[')[0]
+              for _, field, _, _ in string.Formatter().parse(template) if field}
+    values = json.dumps({k: repr(vars.get(k)) for k in sorted(fields)})
+    key = hashlib.sha256((template + values).encode('utf8')).hexdigest()
+    profiles = _rendered_profiles.get(key)
+    if profiles is None:
+        profiles = _rendered_profiles[key] = template.format(**vars)
+    profiles_dir = Path(profiles_dir) if profiles_dir else _private_profiles_dir()
+    profiles_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    stat = profiles_dir.stat()
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(f'{profiles_dir} must be owned by the current user, with mode 0700')
+    # mkdtemp creates the directory with mode 0700 and a random name
+    rendered_dir = Path(tempfile.mkdtemp(prefix='profiles-', dir=profiles_dir))
+    with open(os.open(rendered_dir / 'profiles.yml', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
         f.write(profiles)
-    return fn.parent
+    return rendered_dir
+
+
+#: the profiles rendered by update_dbt_profile(), by hash of template and values
+_rendered_profiles = {}
+@lru_cache(maxsize=None)
+def _private_profiles_dir():
+    # a private temporary directory, created once per process and removed on exit
+    import atexit
+    import shutil
+    import tempfile
+    from pathlib import Path
+    path = Path(tempfile.mkdtemp(prefix='dbtdeploy-'))
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
 
 
 def create_app(server=None, uri=None, **kwargs):
+    import mimetypes
     import os
     import uuid
 
-    from functools import lru_cache
-    from flask import Flask, abort
+    from flask import Flask, Response, abort, request, send_file
     from flask import Blueprint
-    from zipfile import ZipFile
 
     import omegaml as om
+    from dbtdeploy.catalog import ProjectCatalog
+    from dbtdeploy.jobs import JobRunner
+    from dbtdeploy.reports import ReportCache, ReportStore
 
     server = server or Flask(__name__)
     server.config.setdefault('SECRET_KEY', os.environ.get('SECRET_KEY') or uuid.uuid4().hex)
+    # total size of report files cached in memory, in bytes
+    server.config.setdefault('DBT_REPORT_CACHE_BYTES', 256 * 1024 ** 2)
+    # seconds between checks whether a project's report.zip has changed
+    server.config.setdefault('DBT_REPORT_CHECK_INTERVAL', 5)
+    # seconds browsers may use report files before revalidating, index.html is always revalidated
+    server.config.setdefault('DBT_REPORT_MAX_AGE', 60)
+    # if set, reports are extracted to and served from this directory instead of memory
+    server.config.setdefault('DBT_REPORT_DIR', os.environ.get('DBT_REPORT_DIR'))
+    # number of dbt jobs run concurrently, see /api/jobs
+    server.config.setdefault('DBT_JOBS_MAX_WORKERS', 4)
+    # if true, POST /api/jobs starts dbt jobs, only enable behind authentication
+    server.config.setdefault('DBT_JOBS_SUBMIT', False)
+    # seconds between refreshing the list of projects, see /api/projects
+    server.config.setdefault('DBT_CATALOG_REFRESH_INTERVAL', 60)
 
     app = Blueprint('foo', __name__,
                     url_prefix=uri,
                     template_folder='templates')
 
-    file_cache = lru_cache(maxsize=100)
     om = om.setup()
+    if server.config['DBT_REPORT_DIR']:
+        reports = ReportStore(om, server.config['DBT_REPORT_DIR'],
+                              check_interval=server.config['DBT_REPORT_CHECK_INTERVAL'])
+    else:
+        reports = ReportCache(om, max_bytes=server.config['DBT_REPORT_CACHE_BYTES'],
+                              check_interval=server.config['DBT_REPORT_CHECK_INTERVAL'])
+    jobs = JobRunner(om, max_workers=server.config['DBT_JOBS_MAX_WORKERS'])
+    catalog = ProjectCatalog(om, jobs=jobs,
+                             refresh_interval=server.config['DBT_CATALOG_REFRESH_INTERVAL']).start()
+    # -- refresh a project as soon as its jobs finish or its report changes
+    jobs.on_finish = lambda job: catalog.refresh(job.project)
+    reports.on_update = catalog.refresh
 
     @app.route('/')
     def index():
         # present a list of project reports stored in om.datasets
         # -- each project report is stored as dbt/<project>/report.zip
+        # -- the list is read from the catalog, ?q=<text> filters, ?offset=n pages
+        from urllib.parse import urlencode
+        from markupsafe import escape
+        q, offset, limit = request.args.get('q'), request.args.get('offset', 0, type=int), 100
+        total, projects = catalog.projects(q=q, offset=offset, limit=limit)
         href = "<a href='{uri}/{project}/index'>{project}</a><br>"
-        projects = [href.format(project=os.path.basename(os.path.dirname(project)),
-                                uri=uri or '') for project in om.datasets.list('dbt/*')]
+        projects = [href.format(project=escape(project['name']), uri=uri or '') for project in projects]
         text = "<p>select a project to view its dbt report</p>"
+        if offset + limit < total:
+            query = escape(urlencode({'offset': offset + limit, 'q': q or ''}))
+            projects.append(f"<a href='{uri or ''}/?{query}'>next</a>")
         return text + "\n".join(projects) if projects else "No projects found"
 
+    @app.route('/api/projects')
+    def project_list():
+        # query the catalog of projects
+        # -- ?q=<text>&status=<job status>&sort=<name|modified|size, - for descending>&offset=0&limit=100
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        offset = request.args.get('offset', 0, type=int)
+        try:
+            total, projects = catalog.projects(q=request.args.get('q'), status=request.args.get('status'),
+                                               sort=request.args.get('sort', 'name'),
+                                               offset=offset, limit=limit)
+        except ValueError as e:
+            abort(400, str(e))
+        return {'projects': [_project_json(p) for p in projects],
+                'total': total, 'offset': offset, 'limit': limit}
+
+    @app.route('/api/jobs', methods=['GET', 'POST'])
+    def job_list():
+        # list jobs, or run a dbt command for a project
+        # -- POST {"project": "foo", "command": "run", "threads": 4, "select": "my_model"}
+        if request.method == 'POST':
+            if not server.config['DBT_JOBS_SUBMIT']:
+                abort(403, 'submitting jobs is disabled, see DBT_JOBS_SUBMIT')
+            spec = request.get_json(force=True, silent=True) or {}
+            try:
+                job = jobs.submit(spec['project'], command=spec.get('command', 'run'),
+                                  threads=spec.get('threads'), select=spec.get('select'))
+            except (KeyError, ValueError) as e:
+                abort(400, f'invalid job {spec}: {e}')
+            except FileNotFoundError as e:
+                abort(404, str(e))
+            return job.to_dict(), 202
+        return {'jobs': [job.to_dict() for job in jobs.jobs(project=request.args.get('project'))]}
+
+    @app.route('/api/jobs/<job_id>')
+    def job_status(job_id):
+        # the job's status and progress
+        return _get_job(job_id).to_dict()
+
+    @app.route('/api/jobs/<job_id>/log')
+    def job_log(job_id):
+        # the job's output since ?offset=n, use the returned offset in the next request
+        lines, offset = _get_job(job_id).lines(request.args.get('offset', 0, type=int))
+        return {'lines': lines, 'offset': offset}
+
     @app.route('/<project>/index')
     def project(project):
         # open the project report's index.html
-        _send_report_file.cache_clear()
-        project_dir = f'dbt/{project}'
-        return _send_report_file(project_dir, 'index.html')
+        # -- always check if the report has changed, this only affects this project
+        return _send_report_file(project, 'index.html', revalidate=True)
 
     @app.route('/<project>/<path:path>')
     def static_file(project, path):
         # open a static file from the project report
-        project_dir = f'dbt/{project}'
-        return _send_report_file(project_dir, path)
+        return _send_report_file(project, path)
 
     @app.errorhandler(404)
     def handle_exception(e):
@@ -84,17 +260,57 @@ def create_app(server=None, uri=None, **kwargs):
             "exception": str(e),
         }, 404
 
-    @file_cache
-    def _send_report_file(project_dir, filename):
-        report_fn = f'{project_dir}/report.zip'
+    def _project_json(project):
+        return dict(project, modified=project['modified'].isoformat())
+
+    def _get_job(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            abort(404, f'no job {job_id}')
+        return job
+
+    def _send_report_file(project, filename, revalidate=False):
+        # files are read from dbt/<project>/report.zip, see ReportCache, ReportStore
+        # -- range requests are served uncompressed
+        encodings = [e for e, q in request.accept_encodings if q] if not request.range else []
+        if isinstance(reports, ReportStore):
+            resp = _send_stored_file(project, filename, encodings, revalidate)
+        else:
+            resp = _send_cached_file(project, filename, encodings, revalidate)
+        resp.vary.add('Accept-Encoding')
+        resp.cache_control.public = True
+        if revalidate:
+            resp.cache_control.no_cache = True
+        else:
+            resp.cache_control.max_age = server.config['DBT_REPORT_MAX_AGE']
+        return resp
+
+    def _send_cached_file(project, filename, encodings, revalidate):
+        try:
+            rf = reports.file(project, filename, encodings=encodings, revalidate=revalidate)
+        except Exception as e:
+            abort(404, str(e))
+        resp = Response(rf.data, mimetype=rf.mimetype)
+        resp.set_etag(rf.etag)
+        resp.last_modified = rf.modified
+        if rf.encoding:
+            resp.content_encoding = rf.encoding
+        # handles If-None-Match, If-Modified-Since (304) and Range (206)
+        return resp.make_conditional(request, accept_ranges=True, complete_length=len(rf.data))
+
+    def _send_stored_file(project, filename, encodings, revalidate):
         try:
-            with om.datasets.get(report_fn) as f:
-                zipfile = ZipFile(f)
-                data = zipfile.read(f'report/{filename}')
-                zipfile.close()
+            path, encoding = reports.path(project, filename, encodings=encodings, revalidate=revalidate)
         except Exception as e:
             abort(404, str(e))
-        return data
+        # send_file uses the server's sendfile support, and handles conditional and range requests
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        resp = send_file(path, mimetype=mimetype, download_name=os.path.basename(filename),
+                         conditional=True,
+                         max_age=None if revalidate else server.config['DBT_REPORT_MAX_AGE'])
+        if encoding:
+            resp.content_encoding = encoding
+        return resp
 
     server.register_blueprint(app)
     return server
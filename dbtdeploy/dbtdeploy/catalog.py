@@ -0,0 +1,136 @@
+"""
+catalog of dbt projects with a report stored in om.datasets
+"""
+import os
+import threading
+from datetime import datetime
+
+
+class ProjectCatalog:
+    """
+    a cached catalog of dbt projects
+
+    The catalog lists the projects stored in om.datasets as
+    dbt/<project>/report.zip, with their name, report time, report size and
+    the status of their last job. It is read from om.datasets once, and then
+    refreshed every refresh_interval seconds in the background, or for a
+    project on request, see refresh(). Queries are answered
+    from memory, see projects().
+
+    Usage:
+        catalog = ProjectCatalog(om, jobs=runner).start()
+        total, projects = catalog.projects(q='sales', limit=10)
+
+    Args:
+        om (Omega): the omega instance
+        refresh_interval (float): the seconds between refreshing the catalog,
+           0 to never refresh in the background
+        jobs (JobRunner): the job runner, used for the status of the last job
+    """
+    #: the pattern of report datasets
+    PATTERN = 'dbt/*/report.zip'
+    #: the sort orders of projects()
+    SORT_KEYS = ('name', 'modified', 'size')
+
+    def __init__(self, om, refresh_interval=60, jobs=None):
+        self.om = om
+        self.refresh_interval = refresh_interval
+        self.jobs = jobs
+        self.refreshed = None
+        self._projects = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def projects(self, q=None, status=None, sort='name', offset=0, limit=100):
+        """ query the catalog
+
+        Args:
+            q (str): return projects whose name contains q, case insensitive
+            status (str): return projects whose last job has this status
+            sort (str): the sort order, one of SORT_KEYS, prefix with - to sort
+               in descending order, e.g. -modified for the most recent first
+            offset (int): the number of projects to skip
+            limit (int): the maximum number of projects to return
+
+        Returns:
+            (total, projects), the total number of projects matching, and the
+            list of projects, each a dict with keys name, modified, size, status
+        """
+        if self.refreshed is None:
+            self.refresh()
+        key = sort.lstrip('-')
+        if key not in self.SORT_KEYS:
+            raise ValueError(f'sort must be one of {self.SORT_KEYS}, got {sort}')
+        with self._lock:
+            entries = list(self._projects.values())
+        statuses = self._statuses()
+        projects = [dict(entry, status=statuses.get(entry['name'])) for entry in entries]
+        if q:
+            projects = [p for p in projects if q.lower() in p['name'].lower()]
+        if status:
+            projects = [p for p in projects if p['status'] == status]
+        # missing values are sorted last, regardless of the order
+        missing = [p for p in projects if p[key] is None]
+        projects = sorted((p for p in projects if p[key] is not None),
+                          key=lambda p: p[key], reverse=sort.startswith('-')) + missing
+        return len(projects), projects[offset:offset + limit]
+
+    def project(self, name):
+        """ return a project, as in projects(), or None if it does not exist """
+        entry = self._projects.get(name)
+        return dict(entry, status=self._statuses().get(name)) if entry else None
+
+    def refresh(self, project=None):
+        """ read the catalog from om.datasets
+
+        Args:
+            project (str): if given, only refresh this project, e.g. when its
+               job has finished or its report has changed
+        """
+        if project is not None:
+            meta = self.om.datasets.metadata(f'dbt/{project}/report.zip')
+            with self._lock:
+                self._projects.pop(project, None)
+                if meta is not None:
+                    self._projects[project] = self._entry(meta)
+            return self
+        entries = [self._entry(meta) for meta in self.om.datasets.list(self.PATTERN, raw=True)]
+        with self._lock:
+            self._projects = {entry['name']: entry for entry in entries}
+            self.refreshed = datetime.utcnow()
+        return self
+
+    def start(self):
+        """ start refreshing the catalog in the background """
+        if self.refresh_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._refresher, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresher(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # keep the current catalog, retry on the next interval
+                pass
+
+    def _entry(self, meta):
+        size = meta.attributes.get('size') if meta.attributes else None
+        if size is None and meta.gridfile:
+            # reports not stored by publish_report() don't have the size attribute
+            size = getattr(meta.gridfile, 'length', None)
+        return {
+            'name': os.path.basename(os.path.dirname(meta.name)),
+            'modified': meta.modified,
+            'size': size,
+        }
+
+    def _statuses(self):
+        # the status of each project's last job, jobs are listed most recent first
+        jobs = self.jobs.jobs() if self.jobs else []
+        return {job.project: job.status for job in reversed(jobs)}
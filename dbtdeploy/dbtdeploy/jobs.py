@@ -0,0 +1,268 @@
+"""
+run dbt projects concurrently, see JobRunner
+"""
+import logging
+import re
+import shutil
+import subprocess
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+#: the dbt commands a job can run
+COMMANDS = ('run', 'build', 'test', 'seed', 'snapshot', 'compile')
+#: dbt's progress lines, e.g. '1 of 5 OK created sql view model main.foo'
+PROGRESS = re.compile(r'\b(\d+) of (\d+) (OK|PASS|WARN|ERROR|FAIL|SKIP)\b')
+
+
+def dbt_command(project, command='run', dbt_dir=None, threads=None, select=None, profiles_dir=None):
+    """ build the dbt command line for a project
+
+    Args:
+        project (str): the project, i.e. the directory in dbt_dir
+        command (str): the dbt command, see COMMANDS
+        dbt_dir (str): the directory of profiles.yml and the projects,
+           defaults to the dbtdeploy package directory
+        threads (int): passed as dbt --threads, defaults to the profile's threads
+        select (str): passed as dbt --select, defaults to all models
+        profiles_dir (str): the directory of the rendered profiles.yml, defaults
+           to dbt_dir, see update_dbt_profile()
+
+    Returns:
+        the command as a list of arguments
+
+    Raises:
+        ValueError if the command is not supported
+        FileNotFoundError if the project does not exist
+    """
+    dbt_dir = Path(dbt_dir or Path(__file__).parent)
+    project_dir = dbt_dir / project
+    if command not in COMMANDS:
+        raise ValueError(f'dbt command must be one of {COMMANDS}, got {command}')
+    if '/' in project or not (project_dir / 'dbt_project.yml').exists():
+        raise FileNotFoundError(f'dbt project {project} not found in {dbt_dir}')
+    cmd = ['dbt', command, '--profiles-dir', str(profiles_dir or dbt_dir), '--project-dir', str(project_dir)]
+    cmd += ['--threads', str(int(threads))] if threads else []
+    cmd += ['--select', select] if select else []
+    return cmd
+
+
+class Job:
+    """
+    a dbt command running for a project
+
+    The job's output, stdout and stderr, is kept line by line, up to max_lines.
+    Use lines(offset) to read the lines added since a previous call.
+
+    Attributes:
+        id (str): the job's id
+        status (str): queued, running, success or failed
+        done, total (int): the progress, as the number of nodes done of total,
+           parsed from dbt's output
+        errors (int): the number of nodes failed
+        returncode (int): the dbt process' return code
+    """
+
+    def __init__(self, project, command='run', threads=None, select=None, max_lines=10000):
+        self.id = uuid.uuid4().hex
+        self.project = project
+        self.command = command
+        self.threads = threads
+        self.select = select
+        self.status = 'queued'
+        self.created = datetime.utcnow()
+        self.started = None
+        self.ended = None
+        self.returncode = None
+        self.done = 0
+        self.total = 0
+        self.errors = 0
+        self.nlines = 0
+        self.log = deque(maxlen=max_lines)
+        self.finished = threading.Event()
+
+    def append(self, line):
+        self.log.append(line)
+        self.nlines += 1
+        progress = PROGRESS.search(line)
+        if progress:
+            self.done, self.total = int(progress.group(1)), int(progress.group(2))
+            self.errors += progress.group(3) in ('ERROR', 'FAIL')
+
+    def lines(self, offset=0):
+        """ return (lines, offset) of the lines since offset, and the next offset """
+        log, nlines = list(self.log), self.nlines
+        first = nlines - len(log)
+        return log[max(offset - first, 0):], nlines
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'project': self.project,
+            'command': self.command,
+            'threads': self.threads,
+            'select': self.select,
+            'status': self.status,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'ended': self.ended.isoformat() if self.ended else None,
+            'returncode': self.returncode,
+            'progress': {'done': self.done, 'total': self.total, 'errors': self.errors},
+            'lines': self.nlines,
+        }
+
+
+class JobRunner:
+    """
+    run dbt jobs concurrently in a bounded pool
+
+    Each job runs dbt in its own process, at most max_workers at a time,
+    further jobs are queued. The output is read line by line as it is produced,
+    i.e. it is never buffered in full. If om is given, the output is also
+    stored in om.datasets as log_dataset, in batches of batch_size lines, with
+    the columns job, project, time, line.
+
+    Note each dbt process runs its models in --threads threads, so the total
+    number of database connections is up to max_workers * threads.
+
+    Usage:
+        runner = JobRunner(om, max_workers=4)
+        jobs = [runner.submit(project, threads=4) for project in projects]
+        runner.wait(jobs)
+        failed = [job for job in jobs if job.status == 'failed']
+
+    Args:
+        om (Omega): the omega instance, used to render the dbt profile and store
+           the logs, optional. If not given, dbt_dir/profiles.yml is used as is
+        dbt_dir (str): the directory of profiles.yml and the projects, defaults to
+           the dbtdeploy package directory
+        max_workers (int): the number of jobs run concurrently
+        history (int): the number of finished jobs kept
+        log_dataset (str): the name of the logs dataset, or None to not store logs
+        batch_size (int): the number of lines stored at once
+        profile_vars (dict): passed to update_dbt_profile()
+        on_finish (callable): called with the job when it has finished, e.g. to
+           refresh the project in a ProjectCatalog
+    """
+
+    def __init__(self, om=None, dbt_dir=None, max_workers=4, history=100,
+                 log_dataset='dbt/logs', batch_size=100, profile_vars=None, on_finish=None):
+        self.om = om
+        self.dbt_dir = Path(dbt_dir or Path(__file__).parent)
+        self.history = history
+        self.log_dataset = log_dataset
+        self.batch_size = batch_size
+        self.profile_vars = profile_vars or {}
+        self.on_finish = on_finish
+        self._jobs = OrderedDict()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dbt-job')
+
+    def submit(self, project, command='run', threads=None, select=None):
+        """ queue a dbt command for a project
+
+        Args:
+            project (str): the project
+            command (str): the dbt command, see COMMANDS
+            threads (int): passed as dbt --threads
+            select (str): passed as dbt --select
+
+        Returns:
+            the Job
+
+        Raises:
+            see dbt_command()
+        """
+        from dbtdeploy import update_dbt_profile
+
+        profiles_dir = None
+        if self.om is not None:
+            # rendered for this job, never changes the template, removed by _run()
+            profiles_dir = update_dbt_profile(self.dbt_dir / 'profiles.yml', om=self.om, **self.profile_vars)
+        cmd = dbt_command(project, command=command, dbt_dir=self.dbt_dir,
+                          threads=threads, select=select, profiles_dir=profiles_dir)
+        job = Job(project, command=command, threads=threads, select=select)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._futures[job.id] = self._pool.submit(self._run, job, cmd, profiles_dir)
+            self._forget()
+        return job
+
+    def get(self, job_id):
+        """ return the Job, or None if it does not exist """
+        return self._jobs.get(job_id)
+
+    def jobs(self, project=None):
+        """ return all jobs, optionally of a project, most recent first """
+        return [job for job in reversed(list(self._jobs.values()))
+                if project is None or job.project == project]
+
+    def wait(self, jobs=None, timeout=None):
+        """ wait for jobs to finish, defaults to all jobs """
+        jobs = jobs if jobs is not None else self.jobs()
+        futures = [self._futures[job.id] for job in jobs if job.id in self._futures]
+        wait(futures, timeout=timeout)
+        return jobs
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _run(self, job, cmd, profiles_dir=None):
+        job.status, job.started = 'running', datetime.utcnow()
+        batch = []
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    cwd=self.dbt_dir / job.project, text=True, bufsize=1)
+            with proc.stdout:
+                for line in proc.stdout:
+                    line = line.rstrip('\n')
+                    job.append(line)
+                    batch.append({'job': job.id, 'project': job.project,
+                                  'time': datetime.utcnow(), 'line': line})
+                    if len(batch) >= self.batch_size:
+                        self._store(batch)
+                        batch = []
+            job.returncode = proc.wait()
+            job.status = 'success' if job.returncode == 0 else 'failed'
+        except Exception as e:
+            job.append(f'{type(e).__name__}: {e}')
+            job.status = 'failed'
+        finally:
+            if profiles_dir is not None:
+                # the rendered profile contains secrets, keep it no longer than needed
+                shutil.rmtree(profiles_dir, ignore_errors=True)
+            self._store(batch)
+            job.ended = datetime.utcnow()
+            self._finished(job)
+            job.finished.set()
+
+    def _finished(self, job):
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(job)
+        except Exception:
+            logger.exception(f'could not process the end of job {job.id} of project {job.project}')
+
+    def _store(self, batch):
+        if self.om is None or not self.log_dataset or not batch:
+            return
+        import pandas as pd
+        try:
+            self.om.datasets.put(pd.DataFrame(batch), self.log_dataset, append=True)
+        except Exception:
+            # the logs are kept in memory, don't fail the job
+            logger.exception(f'could not store dbt logs in {self.log_dataset}')
+
+    def _forget(self):
+        # keep up to history finished jobs
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished.is_set()]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            self._jobs.pop(job_id)
+            self._futures.pop(job_id)
@@ -0,0 +1,158 @@
+"""
+publish dbt reports and run timings to om.datasets
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZipFile, ZipInfo, is_zipfile
+
+#: the files of target/ served by the report viewer, see create_app()
+ARTIFACTS = ('index.html', 'manifest.json', 'catalog.json', 'run_results.json', 'sources.json')
+#: the date of all zip members, so that the zip only depends on the contents
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+CHUNK_SIZE = 1024 ** 2
+
+
+def zip_report(target_dir, zip_path=None, artifacts=ARTIFACTS):
+    """ zip the dbt artifacts as report/<filename>
+
+    The zip is deterministic, i.e. for the same files it is always the same,
+    byte for byte. Members are ordered by name, have a fixed date, and are
+    compressed at the same level. The zip is built incrementally, i.e. files
+    that have not changed since the previous zip, as per their CRC and size,
+    are copied from the previous zip.
+
+    Args:
+        target_dir (str): the dbt target directory
+        zip_path (str): the zip file, defaults to target_dir/report.zip. If
+           it exists, it is used as the previous zip, and replaced
+        artifacts (list): the files in target_dir to zip, missing files are
+           skipped
+
+    Returns:
+        the path of the zip file
+    """
+    target_dir = Path(target_dir)
+    zip_path = Path(zip_path or target_dir / 'report.zip')
+    previous = ZipFile(zip_path) if zip_path.exists() and is_zipfile(zip_path) else None
+    tmp_path = zip_path.with_name(f'.{zip_path.name}.{uuid.uuid4().hex}')
+    try:
+        with ZipFile(tmp_path, 'w', compression=ZIP_DEFLATED) as zipfile:
+            for filename in sorted(artifacts):
+                path = target_dir / filename
+                if not path.is_file():
+                    continue
+                arcname = f'report/{filename}'
+                crc, size = _crc32(path)
+                info = previous.NameToInfo.get(arcname) if previous else None
+                if info and (info.CRC, info.file_size, info.compress_type) == (crc, size, ZIP_DEFLATED):
+                    _copy_member(previous, info, zipfile)
+                    continue
+                zinfo = ZipInfo(arcname, ZIP_DATE_TIME)
+                zinfo.compress_type = ZIP_DEFLATED
+                zinfo.external_attr = 0o644 << 16
+                with open(path, 'rb') as fin, zipfile.open(zinfo, 'w', force_zip64=size > ZIP64_LIMIT) as fout:
+                    shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+        os.replace(tmp_path, zip_path)
+    finally:
+        previous.close() if previous else None
+        tmp_path.unlink(missing_ok=True)
+    return zip_path
+
+
+def publish_report(om, project, zip_path):
+    """ store the report zip in om.datasets as dbt/<project>/report.zip
+
+    The zip is streamed from disk. If the zip is the same as the stored
+    report, as per its sha256, it is not stored again, i.e. the report's
+    version does not change and the viewer's caches remain valid.
+
+    Returns:
+        the report's Metadata
+    """
+    name = f'dbt/{project}/report.zip'
+    digest = _sha256(zip_path)
+    meta = om.datasets.metadata(name)
+    if meta is not None and meta.attributes.get('sha256') == digest:
+        return meta
+    with open(zip_path, 'rb') as fin:
+        return om.datasets.put(fin, name, attributes={'sha256': digest,
+                                                      'size': os.path.getsize(zip_path)})
+
+
+def publish_timings(om, project, target_dir):
+    """ append the timings of the last dbt run to om.datasets as dbt/<project>/timings
+
+    The timings are read from target_dir/run_results.json, one row per model
+    (node), with the columns project, invocation_id, generated_at, command,
+    unique_id, status, thread_id, execution_time, compile_seconds,
+    execute_seconds, started_at, completed_at. All times are in seconds.
+
+    Returns:
+        the timings as a DataFrame, or None if there were no results
+    """
+    import pandas as pd
+
+    with open(Path(target_dir) / 'run_results.json') as fin:
+        run_results = json.load(fin)
+    metadata = run_results.get('metadata', {})
+    command = run_results.get('args', {}).get('which')
+    rows = []
+    for result in run_results.get('results', []):
+        timing = {t['name']: t for t in result.get('timing', [])}
+        steps = {name: (pd.Timestamp(timing[name]['started_at']),
+                        pd.Timestamp(timing[name]['completed_at'])) if name in timing else (None, None)
+                 for name in ('compile', 'execute')}
+        rows.append({
+            'project': project,
+            'invocation_id': metadata.get('invocation_id'),
+            'generated_at': pd.Timestamp(metadata.get('generated_at')),
+            'command': command,
+            'unique_id': result['unique_id'],
+            'status': result.get('status'),
+            'thread_id': result.get('thread_id'),
+            'execution_time': result.get('execution_time'),
+            'compile_seconds': _seconds(*steps['compile']),
+            'execute_seconds': _seconds(*steps['execute']),
+            'started_at': steps['execute'][0],
+            'completed_at': steps['execute'][1],
+        })
+    if not rows:
+        return None
+    df = pd.DataFrame(rows)
+    om.datasets.put(df, f'dbt/{project}/timings', append=True)
+    return df
+
+
+def _seconds(start, end):
+    return (end - start).total_seconds() if start is not None else None
+
+
+def _crc32(path):
+    from zlib import crc32
+    crc, size = 0, 0
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+            crc, size = crc32(chunk, crc), size + len(chunk)
+    return crc, size
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_member(source, info, zipfile):
+    # copy a member from the source zip, with the same ZipInfo
+    # -- zipfile cannot copy compressed data as is, the member is decompressed and compressed again
+    zinfo = ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    with source.open(info) as fin, zipfile.open(zinfo, 'w', force_zip64=info.file_size > ZIP64_LIMIT) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
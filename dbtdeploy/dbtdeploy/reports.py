@@ -0,0 +1,418 @@
+"""
+cache of dbt report files stored in om.datasets as dbt/<project>/report.zip
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+from time import monotonic
+from zipfile import ZipFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+#: the compressed variants, in order of preference
+#: -- moderate levels, the highest levels take seconds for multi-MB json files
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS = dict(br=lambda data: brotli.compress(data, quality=5), **COMPRESSORS)
+#: the types of files that are compressed
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+#: a report file, see ReportCache.file()
+ReportFile = namedtuple('ReportFile', ['data', 'etag', 'modified', 'mimetype', 'encoding'])
+
+
+class ReportCache:
+    """
+    a byte-bounded cache of dbt report files
+
+    Each project's report is stored in om.datasets as dbt/<project>/report.zip,
+    containing the files of the dbt docs as report/<filename>. The cache keeps
+
+    * the report's opened zip file per project, i.e. the zip's central directory
+      is read once, and a cache miss only reads the one member requested
+    * the files read, up to max_bytes in total, evicting the least recently
+      used files first. Files larger than max_bytes are not cached
+    * compressed variants (br if available, gzip) of text files, see file().
+      Each variant is compressed once per report version, by one thread, and
+      is kept with the report, i.e. it is not evicted, see Report.compressed()
+
+    The report's version, i.e. its GridFS file id and modification time, is
+    checked at most every check_interval seconds, or on request. If the report
+    has changed, the project's files are evicted, other projects are not affected.
+
+    Usage:
+        reports = ReportCache(om)
+        data = reports.get('myproject', 'index.html')
+
+    Args:
+        om (Omega): the omega instance
+        max_bytes (int): the maximum size of all files cached
+        check_interval (float): the seconds between checking a report's version
+        min_compress (int): the minimum size of files to compress, in bytes
+        on_update (callable): called with the project when a new version of its
+           report is found, or when its report was deleted
+    """
+
+    def __init__(self, om, max_bytes=256 * 1024 ** 2, check_interval=5, min_compress=1024,
+                 on_update=None):
+        self.om = om
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.min_compress = min_compress
+        self.on_update = on_update
+        self.nbytes = 0
+        self._files = OrderedDict()
+        self._reports = {}
+        self._project_locks = {}
+        self._lock = threading.RLock()
+
+    def get(self, project, filename, revalidate=False):
+        """ return the contents of a report file
+
+        Args:
+            project (str): the project name
+            filename (str): the path of the file in the report
+            revalidate (bool): if True, check the report's version now
+
+        Returns:
+            the file's contents, as bytes
+
+        Raises:
+            FileNotFoundError if the report does not exist
+            KeyError if the file does not exist in the report
+        """
+        report = self.report(project, revalidate=revalidate)
+        return self._read(project, report, filename)
+
+    def file(self, project, filename, encodings=None, revalidate=False):
+        """ return a report file with its http metadata
+
+        Args:
+            project (str): the project name
+            filename (str): the path of the file in the report
+            encodings (list): the content encodings accepted by the client,
+               e.g. ['br', 'gzip']. If given and the file is compressible,
+               returns the preferred compressed variant
+            revalidate (bool): if True, check the report's version now
+
+        Returns:
+            ReportFile(data, etag, modified, mimetype, encoding), where etag
+            is derived from the zip member's CRC and size, and encoding is
+            None for the uncompressed file
+
+        Raises:
+            see get()
+        """
+        report = self.report(project, revalidate=revalidate)
+        info = report.info(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        if (mimetype.startswith(COMPRESSIBLE) and
+                self.min_compress <= info.file_size <= self.max_bytes):
+            encoding = next((e for e in COMPRESSORS if e in (encodings or [])), None)
+        data = self._read(project, report, filename, encoding=encoding)
+        etag = f'{info.CRC:08x}-{info.file_size}' + (f'-{encoding}' if encoding else '')
+        return ReportFile(data, etag, report.modified, mimetype, encoding)
+
+    def _read(self, project, report, filename, encoding=None):
+        if encoding:
+            return report.compressed(filename, encoding, lambda: self._read(project, report, filename))
+        key = (project, report.version, filename)
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+                return self._files[key]
+        data = report.read(filename)
+        self._put(key, data)
+        return data
+
+    def report(self, project, revalidate=False):
+        """ return the project's current Report """
+        requested = monotonic()
+        report = self._reports.get(project)
+        if self._is_fresh(report, revalidate, requested):
+            return report
+        # only requests of this project wait for om.datasets, the global lock
+        # is held to swap the project's report, not while reading it
+        with self._project_lock(project):
+            report = self._reports.get(project)
+            if self._is_fresh(report, revalidate, requested):
+                return report
+            meta = self.om.datasets.metadata(f'dbt/{project}/report.zip')
+            if meta is None:
+                self.invalidate(project)
+                if report is not None:
+                    _notify(self.on_update, project)
+                raise FileNotFoundError(f'no report found for project {project}')
+            version = report_version(meta)
+            if report is None or report.version != version:
+                report = Report(meta, version)
+                with self._lock:
+                    self.invalidate(project)
+                    self._reports[project] = report
+                _notify(self.on_update, project)
+            report.checked = monotonic()
+            return report
+
+    def _is_fresh(self, report, revalidate, requested):
+        # a report checked since the request, e.g. by another thread, is always fresh
+        if report is None:
+            return False
+        if revalidate:
+            return report.checked >= requested
+        return monotonic() - report.checked < self.check_interval
+
+    def _project_lock(self, project):
+        with self._lock:
+            return self._project_locks.setdefault(project, threading.Lock())
+
+    def invalidate(self, project):
+        """ evict all files of a project """
+        with self._lock:
+            # the report is not closed, it may still be read by another thread
+            self._reports.pop(project, None)
+            for key in [k for k in self._files if k[0] == project]:
+                self.nbytes -= len(self._files.pop(key))
+
+    def clear(self):
+        with self._lock:
+            for project in list(self._reports):
+                self.invalidate(project)
+            self._files.clear()
+            self.nbytes = 0
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._files:
+                return
+            self._files[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._files.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+
+class Report:
+    """
+    an opened report.zip
+
+    Args:
+        meta (Metadata): the report's metadata in om.datasets
+        version (tuple): the report's version
+    """
+
+    def __init__(self, meta, version):
+        self.version = version
+        self.modified = meta.modified
+        self.checked = monotonic()
+        self._file = meta.gridfile.get()
+        self._zipfile = ZipFile(self._file)
+        self._compressed = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def read(self, filename):
+        """ read one member, report/<filename> """
+        return self._zipfile.read(f'report/{filename}')
+
+    def info(self, filename):
+        """ return the ZipInfo of report/<filename> """
+        return self._zipfile.getinfo(f'report/{filename}')
+
+    def compressed(self, filename, encoding, read):
+        """ return the compressed variant of a file, compress it once
+
+        Args:
+            filename (str): the path of the file in the report
+            encoding (str): the encoding, see COMPRESSORS
+            read (callable): returns the file's contents
+        """
+        key = (filename, encoding)
+        data = self._compressed.get(key)
+        if data is None:
+            # other threads requesting the same variant wait instead of compressing it again
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+            with lock:
+                data = self._compressed.get(key)
+                if data is None:
+                    data = self._compressed[key] = COMPRESSORS[encoding](read())
+        return data
+
+
+class ReportStore:
+    """
+    an on-disk store of extracted dbt reports
+
+    As ReportCache, but each project's report.zip is extracted once into a
+    local directory, <root>/<project>/<key>, where key is a hash of the report's
+    version. The files are served from disk, e.g. by flask.send_file. This way
+    all processes on a host, e.g. gunicorn workers, share the extracted files
+    and the OS page cache, instead of each keeping its own copy in memory.
+
+    * a report is extracted into a temporary directory, which is then renamed.
+      If another process has extracted the same version meanwhile, its
+      directory is used
+    * compressed variants of text files are written next to the file, as
+      <filename>.gz (.br if brotli is available), on extracting the report,
+      i.e. requests never compress files
+    * only the keep most recent versions of a project are kept on disk, older
+      versions are removed on extracting a new version
+
+    Usage:
+        reports = ReportStore(om, '/var/cache/dbtdeploy')
+        path, encoding = reports.path('myproject', 'index.html')
+
+    Args:
+        om (Omega): the omega instance
+        root (str): the root directory
+        check_interval (float): the seconds between checking a report's version
+        keep (int): the number of versions kept per project
+        min_compress (int): the minimum size of files to compress, in bytes
+        on_update (callable): as in ReportCache
+    """
+    SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+    def __init__(self, om, root, check_interval=5, keep=2, min_compress=1024, on_update=None):
+        self.om = om
+        self.root = Path(root)
+        self.check_interval = check_interval
+        self.keep = keep
+        self.min_compress = min_compress
+        self.on_update = on_update
+        self._reports = {}
+        self._project_locks = {}
+        self._lock = threading.RLock()
+
+    def path(self, project, filename, encodings=None, revalidate=False):
+        """ return the path of a report file
+
+        Args:
+            project (str): the project name
+            filename (str): the path of the file in the report
+            encodings (list): the content encodings accepted by the client,
+               e.g. ['br', 'gzip']. If given and the file is compressible,
+               returns the path of the preferred compressed variant
+            revalidate (bool): if True, check the report's version now
+
+        Returns:
+            (path, encoding), where encoding is None for the uncompressed file
+
+        Raises:
+            FileNotFoundError if the report or the file does not exist
+        """
+        report_dir = self.report(project, revalidate=revalidate)
+        path = (report_dir / filename).resolve()
+        if report_dir not in path.parents or not path.is_file():
+            raise FileNotFoundError(f'no file {filename} in report of project {project}')
+        # the variants written by _extract(), if the file is compressible
+        encoding = next((e for e in COMPRESSORS if e in (encodings or []) and
+                         self._compressed(path, e).is_file()), None)
+        if encoding:
+            path = self._compressed(path, encoding)
+        return path, encoding
+
+    def report(self, project, revalidate=False):
+        """ return the directory of the project's current report """
+        requested = monotonic()
+        report_dir, checked = self._reports.get(project, (None, 0))
+        if self._is_fresh(report_dir, checked, revalidate, requested):
+            return report_dir
+        # as ReportCache.report(), only requests of this project wait
+        with self._project_lock(project):
+            report_dir, checked = self._reports.get(project, (None, 0))
+            if self._is_fresh(report_dir, checked, revalidate, requested):
+                return report_dir
+            meta = self.om.datasets.metadata(f'dbt/{project}/report.zip')
+            if meta is None:
+                if self._reports.pop(project, None) is not None:
+                    _notify(self.on_update, project)
+                raise FileNotFoundError(f'no report found for project {project}')
+            key = hashlib.md5(repr(report_version(meta)).encode('utf8')).hexdigest()
+            previous, report_dir = report_dir, self.root / project / key
+            if not report_dir.exists():
+                self._extract(meta, report_dir)
+                self._evict(project)
+            self._reports[project] = (report_dir.resolve(), monotonic())
+            if previous != self._reports[project][0]:
+                _notify(self.on_update, project)
+            return self._reports[project][0]
+
+    def _is_fresh(self, report_dir, checked, revalidate, requested):
+        if report_dir is None:
+            return False
+        if revalidate:
+            return checked >= requested
+        return monotonic() - checked < self.check_interval
+
+    def _project_lock(self, project):
+        with self._lock:
+            return self._project_locks.setdefault(project, threading.Lock())
+
+    def _extract(self, meta, report_dir):
+        # extract into a temporary directory, then rename it atomically
+        tmp_dir = report_dir.parent / f'.tmp-{uuid.uuid4().hex}'
+        try:
+            with ZipFile(meta.gridfile.get()) as zipfile:
+                members = [m for m in zipfile.namelist() if m.startswith('report/')]
+                zipfile.extractall(tmp_dir, members=members)
+            self._compress(tmp_dir / 'report')
+            os.rename(tmp_dir / 'report', report_dir)
+        except OSError:
+            # another process has extracted this version meanwhile
+            if not report_dir.exists():
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _evict(self, project):
+        # keep the most recent versions, remove older ones
+        versions = sorted((d for d in (self.root / project).iterdir()
+                           if d.is_dir() and not d.name.startswith('.')),
+                          key=lambda d: d.stat().st_mtime, reverse=True)
+        for stale in versions[self.keep:]:
+            shutil.rmtree(stale, ignore_errors=True)
+
+    def _compress(self, extracted_dir):
+        # write the compressed variants of all compressible files, once per version
+        for path in [p for p in extracted_dir.rglob('*') if p.is_file()]:
+            mimetype = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+            if not mimetype.startswith(COMPRESSIBLE) or path.stat().st_size < self.min_compress:
+                continue
+            data = path.read_bytes()
+            for encoding, compress in COMPRESSORS.items():
+                self._compressed(path, encoding).write_bytes(compress(data))
+
+    def _compressed(self, path, encoding):
+        return path.with_name(path.name + self.SUFFIXES[encoding])
+
+
+def _notify(callback, project):
+    # the report is served regardless of the callback
+    if callback is None:
+        return
+    try:
+        callback(project)
+    except Exception:
+        logger.exception(f'could not notify the update of the report of project {project}')
+
+
+def report_version(meta):
+    """ the version of a report, its GridFS file id and modification time """
+    return (str(meta.gridfile.grid_id), meta.modified)
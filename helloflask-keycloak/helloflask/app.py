@@ -1,8 +1,10 @@
-from flask import Blueprint, render_template, Flask, request
+from flask import Blueprint, render_template, Flask, request, abort, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 
-from helloflask.dbmodels import Base, User
+from helloflask.apphublib import OMEGA_REGISTRY
+from helloflask.dbmodels import Database, User
+from helloflask.dbmodels.bulk import import_users, read_users
 
 
 def create_app(server=None, uri=None, **kwargs):
@@ -19,11 +21,12 @@ def create_app(server=None, uri=None, **kwargs):
 
     om = om.setup()
 
+    # the engine is resolved and the schema migrated once, see init_db()
+    db = Database(om, 'sqldb')
+
     def init_db():
         # call this anywhere you need the db connection
-        connection = om.datasets.get('sqldb', raw=True)
-        Base.metadata.create_all(connection.engine)
-        return connection
+        return db
 
     @app.route('/')
     def index():
@@ -55,15 +58,43 @@ def create_app(server=None, uri=None, **kwargs):
     @app.route('/update', methods=['GET', 'POST'])
     @login_required
     def update():
-        connection = init_db()
-        if request.method == 'POST':
-            with Session(connection.engine) as session:
+        import pandas as pd
+
+        db = init_db()
+        # users are listed by id, starting after ?after=<id>
+        after = request.args.get('after', 0, type=int)
+        limit = max(min(request.args.get('limit', 50, type=int), 1000), 1)
+        with db.session() as session:
+            if request.method == 'POST':
                 user = User(name=request.form.get('name'),
                             fullname=request.form.get('fullname'))
                 session.add(user)
                 session.commit()
-        all_users = om.datasets.get('sqldb', sql='select * from myapp_user_account')
-        return render_template('helloflask/update.html', users=all_users)
+            users = session.scalars(select(User)
+                                    .where(User.id > after)
+                                    .order_by(User.id)
+                                    .limit(limit + 1)).all()
+        next_after = users[limit - 1].id if len(users) > limit else None
+        all_users = pd.DataFrame([user.as_dict() for user in users[:limit]],
+                                 columns=[c.name for c in User.__table__.columns])
+        return render_template('helloflask/update.html', users=all_users,
+                               next_after=next_after, limit=limit)
+
+    @app.route('/api/users', methods=['POST'])
+    @login_required
+    def import_users_api():
+        # bulk insert users, json or csv, ?upsert=true to update existing users by id
+        if not current_user.has_perm('power-user'):
+            abort(403)
+        try:
+            users = read_users(request.get_data(), content_type=request.mimetype)
+        except ValueError as e:
+            return jsonify({'error': f'cannot read users: {e}'}), 400
+        upsert = request.args.get('upsert', 'false').lower() in ('true', '1', 'yes')
+        with init_db().session() as session:
+            result = import_users(session, users, upsert=upsert)
+            session.commit()
+        return jsonify(result)
 
     # set any configuration for use when deployed in apphub here
     server.config['APP_TITLE'] = 'omega-ml app'
@@ -76,7 +107,7 @@ def create_app(server=None, uri=None, **kwargs):
         }
     }
     server.config['APPHUB_APP_SECURE_NOPROTECT'] = \
-        (f'{uri}/?$', '.*/login.*', '.*/logout.*', '.*/authorize', '.*/static/.*', '.*/healthz')
+        (f'{uri or ""}/?$', '.*/login.*', '.*/logout.*', '.*/authorize', '.*/static/.*', '.*/healthz')
     # configure permissions
     server.config['APPHUB_PERMISSIONS'] = {
         'admin': ['admin'],
@@ -89,6 +120,10 @@ def create_app(server=None, uri=None, **kwargs):
             'qualifier': 'poweruser',
         }
     }
+    # create the omega instances once per process, see current_user.om_for_perm()
+    OMEGA_REGISTRY.warm(server.config)
+    # connect and create the schema once per process, instead of per request
+    db.warm()
     return app
 
 if __name__ == '__main__':
@@ -6,4 +6,5 @@ published at https://www.omegaml.io/eula. It is restricted to use with
 omega-ml commercial edition.
 """
 from .localdev import local_testing
-from .users import User, Permission
+from .routes import RouteProtection, protect_routes
+from .users import User, Permission, PermissionIndex, OMEGA_REGISTRY
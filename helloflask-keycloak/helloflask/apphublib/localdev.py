@@ -10,7 +10,8 @@ def local_testing(server, app, local_init=None):
     import flask
     from werkzeug.utils import redirect
     from flask_login import LoginManager, login_user
-    from .users import User, AnonymousUser
+    from .routes import protect_routes
+    from .users import User, AnonymousUser, OMEGA_REGISTRY
 
     # see https://flask-login.readthedocs.io/en/latest/
     login_manager = LoginManager()
@@ -88,4 +89,8 @@ def local_testing(server, app, local_init=None):
     server.register_blueprint(app)
     # call local init for user customization
     local_init(server, app) if callable(local_init) else None
+    # create the omega instances for permissions once, instead of on first use
+    OMEGA_REGISTRY.warm(server.config)
+    # require login and JWT_CLAIMS_RULES as apphub does, compiled on first request
+    protect_routes(server, login_manager)
     return server
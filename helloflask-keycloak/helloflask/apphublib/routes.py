@@ -0,0 +1,139 @@
+"""
+Copyright (c) one2seven GmbH, makers of omega|ml, http://omegaml.io
+"""
+import re
+from functools import lru_cache
+
+import flask
+
+#: a claim rule that is a plain alternative of values, e.g. 'user|admin'
+LITERALS = re.compile(r'[\w\-@: ]+(\|[\w\-@: ]+)*')
+
+
+class ClaimRule:
+    """
+    A required claim, e.g. groups must match 'user|admin'
+
+    The claim's value, or any of its values if it is a list, must fully match
+    the pattern. Patterns that are plain alternatives of values, e.g.
+    'user|admin', are compiled to a set of values, checked without regex.
+    """
+
+    def __init__(self, claim, pattern):
+        self.claim = claim
+        self.pattern = pattern
+        if LITERALS.fullmatch(pattern):
+            self.values, self.regex = frozenset(pattern.split('|')), None
+        else:
+            self.values, self.regex = None, re.compile(pattern)
+
+    def matches(self, values):
+        # values is the set of the claim's values, see claim_set()
+        if self.values is not None:
+            return not self.values.isdisjoint(values)
+        return any(self.regex.fullmatch(value) for value in values)
+
+
+class RouteProtection:
+    """
+    The route protection of an app, compiled once
+
+    Compiles APPHUB_APP_SECURE_NOPROTECT, i.e. the route regexes that do not
+    require login, into one combined regex, and JWT_CLAIMS_RULES, i.e.
+    route regex => { claim: claim regex }, into ClaimRules. Routes are
+    matched from the start of the path, as by re.match. The decision for a
+    path is cached, up to max_paths paths, and users' claims are converted
+    to sets once per claims, see claim_set().
+
+    The matcher is kept per app in app.extensions, and is recompiled if
+    the configuration is replaced.
+
+    Usage:
+        routes = RouteProtection.for_app(server)
+        protected, rules = routes.decide('/report')
+        allowed = routes.allowed('/report', current_user)
+    """
+    EXTENSION = 'apphub_routes'
+
+    def __init__(self, noprotect=None, claims_rules=None, max_paths=4096):
+        self.source = (noprotect, claims_rules)
+        noprotect = [noprotect] if isinstance(noprotect, str) else list(noprotect or [])
+        self.noprotect = re.compile('|'.join(f'(?:{p})' for p in noprotect)) if noprotect else None
+        # -- apphub accepts both 'require' and 'required'
+        claims_rules = claims_rules or {}
+        rules = dict(claims_rules.get('require', {}), **claims_rules.get('required', {}))
+        self.rules = [(re.compile(route), tuple(ClaimRule(claim, pattern) for claim, pattern in claims.items()))
+                      for route, claims in rules.items()]
+        self.any_rule = re.compile('|'.join(f'(?:{r.pattern})' for r, _ in self.rules)) if self.rules else None
+        self.decide = lru_cache(maxsize=max_paths)(self._decide)
+
+    @classmethod
+    def for_app(cls, app=None):
+        # return the app's matcher, compile it if the configuration has changed
+        app = app or flask.current_app
+        noprotect = app.config.get('APPHUB_APP_SECURE_NOPROTECT')
+        claims_rules = app.config.get('JWT_CLAIMS_RULES')
+        routes = app.extensions.get(cls.EXTENSION)
+        if routes is None or routes.source[0] is not noprotect or routes.source[1] is not claims_rules:
+            routes = app.extensions[cls.EXTENSION] = cls(noprotect, claims_rules)
+        return routes
+
+    def _decide(self, path):
+        # (protected, rules) for the path, rules are the ClaimRules of all matching routes
+        if self.noprotect is not None and self.noprotect.match(path):
+            return False, ()
+        if self.any_rule is None or not self.any_rule.match(path):
+            return True, ()
+        return True, tuple(rule for route, claims in self.rules if route.match(path) for rule in claims)
+
+    def allowed(self, path, user):
+        # True if the user's claims satisfy all rules of the path
+        protected, rules = self.decide(path)
+        return all(rule.matches(claim_set(user, rule.claim)) for rule in rules)
+
+
+def claim_set(user, claim):
+    # the set of the user's claim values, computed once per claims
+    # -- login processing may replace user.claims
+    cached = user.__dict__.get('_claim_sets')
+    if cached is None or cached[0] is not user.claims:
+        cached = user._claim_sets = (user.claims, {})
+    values = cached[1].get(claim)
+    if values is None:
+        value = user.claims.get(claim)
+        value = [] if value is None else value if isinstance(value, (list, tuple, set)) else [value]
+        values = cached[1][claim] = frozenset(str(v) for v in value)
+    return values
+
+
+def protect_routes(server, login_manager=None):
+    """
+    Require login and JWT_CLAIMS_RULES for all routes of the server
+
+    Applies if APPHUB_APP_SECURE_ROUTES is True. Routes matching
+    APPHUB_APP_SECURE_NOPROTECT do not require login. For other routes,
+    anonymous users are passed to login_manager.unauthorized(), and users
+    whose claims do not satisfy JWT_CLAIMS_RULES get 403 Forbidden.
+
+    Args:
+        server (Flask): the flask server
+        login_manager (LoginManager): the login manager, defaults to the
+           server's
+    """
+    from flask_login import current_user
+
+    @server.before_request
+    def check_route():
+        if not flask.current_app.config.get('APPHUB_APP_SECURE_ROUTES'):
+            return
+        routes = RouteProtection.for_app()
+        path = flask.request.path
+        protected, rules = routes.decide(path)
+        if not protected:
+            return
+        if not current_user.is_authenticated:
+            return (login_manager or flask.current_app.login_manager).unauthorized()
+        if rules and not routes.allowed(path, current_user):
+            flask.abort(403)
+
+    return server
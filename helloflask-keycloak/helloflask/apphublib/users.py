@@ -1,48 +1,184 @@
 """
 Copyright (c) one2seven GmbH, makers of omega|ml, http://omegaml.io
 """
+import json
+import threading
+
 import flask
 from flask_login import UserMixin, AnonymousUserMixin
 
 
 class Permission:
-    PERMISSIONS = {}
+    """
+    A permission, granted to the members of any of its groups
+
+    Permissions are compiled per app from APPHUB_PERMISSIONS, see
+    PermissionIndex. Use Permission.get(permission) to get the permission
+    of the current app.
+    """
 
-    def __init__(self, permission, groups=None):
-        Permission.PERMISSIONS[permission] = self
-        self.groups = groups or []
+    def __init__(self, permission, groups=None, bit=0):
+        self.permission = permission
+        self.groups = frozenset(groups or [])
+        self.bit = bit
 
     def allow_for(self, group):
-        self.groups.append(group)
+        # allow the permission for the group, in the current app
+        PermissionIndex.for_app().allow(self.permission, group)
 
     def allowed(self, user):
-        return any(g in user.groups for g in self.groups)
+        return not self.groups.isdisjoint(user.groups)
 
     @classmethod
     def get(cls, permission):
-        if not Permission.PERMISSIONS:
-            Permission.PERMISSIONS.update({
-                p: Permission(p, groups=g)
-                for p, g in flask.current_app.config.get('APPHUB_PERMISSIONS', {}).items()})
-        return Permission.PERMISSIONS.get(permission)
+        return PermissionIndex.for_app().permissions.get(permission)
+
+
+class PermissionIndex:
+    """
+    The permissions of an app, compiled once
+
+    APPHUB_PERMISSIONS, i.e. permission => [group, ...], is compiled into one
+    bit per permission, and a bitmap of the permissions granted per group.
+    A user's permissions are the union of the bitmaps of their groups, computed
+    once per user, so that checking any number of permissions is a bitwise and.
+
+    The index is kept per app in app.extensions, and is recompiled if
+    APPHUB_PERMISSIONS or JWT_GROUPS_ATTRIBUTE is replaced.
+
+    Usage:
+        index = PermissionIndex.for_app(server)
+        mask = index.mask(['user', 'admin'])
+        granted = index.granted(mask, ['user', 'power-user'])
+    """
+    EXTENSION = 'apphub_permissions'
+
+    def __init__(self, permissions=None, groups_attribute='groups'):
+        self.source = permissions
+        self.groups_attribute = groups_attribute
+        self.permissions = {}
+        self.group_bits = {}
+        # incremented on every change, invalidates the users' masks
+        self.version = 0
+        self._lock = threading.Lock()
+        for permission, groups in (permissions or {}).items():
+            self.allow(permission, *groups)
+
+    @classmethod
+    def for_app(cls, app=None):
+        # return the app's index, compile it if APPHUB_PERMISSIONS has changed
+        app = app or flask.current_app
+        # -- None if not configured, i.e. the same on every call
+        permissions = app.config.get('APPHUB_PERMISSIONS')
+        groups_attribute = app.config.get('JWT_GROUPS_ATTRIBUTE', 'groups')
+        index = app.extensions.get(cls.EXTENSION)
+        if index is None or index.source is not permissions or index.groups_attribute != groups_attribute:
+            index = app.extensions[cls.EXTENSION] = cls(permissions, groups_attribute=groups_attribute)
+        return index
+
+    def allow(self, permission, *groups):
+        # allow the permission for the groups
+        with self._lock:
+            p = self.permissions.get(permission)
+            if p is None:
+                p = self.permissions[permission] = Permission(permission, bit=1 << len(self.permissions))
+            p.groups = p.groups | frozenset(groups)
+            for group in groups:
+                self.group_bits[group] = self.group_bits.get(group, 0) | p.bit
+            self.version += 1
+        return p
+
+    def mask(self, groups):
+        # the bitmap of the permissions granted to the groups
+        mask = 0
+        for group in groups:
+            mask |= self.group_bits.get(group, 0)
+        return mask
+
+    def granted(self, mask, permissions):
+        # True if the mask grants all permissions, unknown permissions are never granted
+        required = 0
+        for permission in permissions:
+            p = self.permissions.get(permission)
+            if p is None:
+                return False
+            required |= p.bit
+        return mask & required == required
+
+
+class OmegaRegistry:
+    """
+    A process-wide registry of omega instances
+
+    Each instance is created once per setup kwargs, e.g. per qualifier, and
+    then reused by all requests and threads, including its database
+    connection pools.
+
+    Usage:
+        om = OMEGA_REGISTRY.get(qualifier='poweruser', make_default=False)
+        # warm at app start, from APPHUB_PERMISSIONS_OMEGA
+        OMEGA_REGISTRY.warm(server.config)
+    """
+
+    def __init__(self):
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, **setup_kwargs):
+        # return the instance for om.setup(**setup_kwargs)
+        key = self.key(setup_kwargs)
+        om = self._instances.get(key)
+        if om is None:
+            with self._lock:
+                om = self._instances.get(key)
+                if om is None:
+                    import omegaml
+                    om = self._instances[key] = omegaml.setup(**setup_kwargs)
+        return om
+
+    def warm(self, config):
+        # create the instances of APPHUB_PERMISSIONS_OMEGA, return the permissions warmed
+        warmed = []
+        for permission, setup_kwargs in config.get('APPHUB_PERMISSIONS_OMEGA', {}).items():
+            try:
+                self.get(**self.setup_kwargs(setup_kwargs))
+            except Exception:
+                # not available at app start, get() will retry on first use
+                continue
+            warmed.append(permission)
+        return warmed
+
+    def clear(self):
+        with self._lock:
+            self._instances.clear()
+
+    @staticmethod
+    def key(setup_kwargs):
+        return json.dumps(setup_kwargs, sort_keys=True, default=repr)
+
+    @staticmethod
+    def setup_kwargs(setup_kwargs):
+        # the kwargs for a permission, never changing the configuration
+        return dict(setup_kwargs, make_default=setup_kwargs.get('make_default', False))
+
+
+#: the omega instances of this process, see UserOmegaMixin
+OMEGA_REGISTRY = OmegaRegistry()
 
 
 class UserOmegaMixin:
     @property
     def om(self):
         # return the session configuration
-        import omegaml as om
-        return om.setup()
+        return OMEGA_REGISTRY.get()
 
     def om_for_perm(self, permission):
         # return the configuration for the user
-        import omegaml as om
         self: User
         if self.has_perm(permission):
             omega_config = flask.current_app.config.get('APPHUB_PERMISSIONS_OMEGA', {})
-            setup_kwargs = omega_config.get(permission, {})
-            setup_kwargs.setdefault('make_default', False)
-            return om.setup(**setup_kwargs)
+            setup_kwargs = OmegaRegistry.setup_kwargs(omega_config.get(permission, {}))
+            return OMEGA_REGISTRY.get(**setup_kwargs)
         raise ValueError(f'user {self} does not have permission {permission}')
 
 
@@ -60,12 +196,28 @@ class User(UserOmegaMixin, UserMixin):
 
     @property
     def groups(self):
-        group_claim = flask.current_app.config.get('JWT_GROUPS_ATTRIBUTE', 'groups')
-        return self.claims.get(group_claim, [])
+        return self._permissions()[0]
 
     def has_perm(self, permission):
-        p = Permission.get(permission)
-        return p.allowed(self) if p else False
+        return self.has_perms([permission])
+
+    def has_perms(self, permissions):
+        # True if the user has all permissions
+        index = PermissionIndex.for_app()
+        return index.granted(self._permissions(index)[2], permissions)
+
+    def _permissions(self, index=None):
+        # (groups, group set, permission mask) of the user, computed once per claims
+        # -- login processing may replace self.claims, the index may be recompiled
+        index = index or PermissionIndex.for_app()
+        cached = self.__dict__.get('_cached_permissions')
+        if (cached is None or cached[0] is not self.claims or cached[1] is not index
+                or cached[2] != index.version):
+            groups = self.claims.get(index.groups_attribute, [])
+            group_set = frozenset(groups)
+            cached = (self.claims, index, index.version, (groups, group_set, index.mask(group_set)))
+            self._cached_permissions = cached
+        return cached[3]
 
 
 class AnonymousUser(UserOmegaMixin, AnonymousUserMixin):
@@ -75,3 +227,6 @@ class AnonymousUser(UserOmegaMixin, AnonymousUserMixin):
 
     def has_perm(self, permission):
         return False
+
+    def has_perms(self, permissions):
+        return False
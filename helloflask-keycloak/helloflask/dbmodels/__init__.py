@@ -1,10 +1,18 @@
+import logging
+import threading
+
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import inspect
+from sqlalchemy import text
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -33,3 +41,87 @@ class Address(Base):
 
     def __repr__(self):
         return f"Address(id={self.id!r}, email_address={self.email_address!r})"
+
+
+def migrate(engine, metadata=Base.metadata):
+    """ create or migrate the schema
+
+    Missing tables are created. Missing nullable columns of existing tables
+    are added. Other changes, e.g. missing non-nullable columns, require a
+    manual migration.
+
+    Returns:
+        the list of changes applied, e.g. ['create table myapp_address']
+
+    Raises:
+        RuntimeError if the schema requires a manual migration
+    """
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    changes = [f'create table {table}' for table in metadata.tables if table not in existing]
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                if not column.nullable or column.primary_key:
+                    raise RuntimeError(f'table {table.name} requires a migration to add column {column.name}')
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                changes.append(f'add column {table.name}.{column.name}')
+    for change in changes:
+        logger.info(f'migrated {engine.url!r}: {change}')
+    return changes
+
+
+class Database:
+    """
+    The app's SQL database, resolved once
+
+    The engine is resolved from the om.datasets connection on first use,
+    and then reused, i.e. sessions share the engine's connection pool. The
+    schema is created or migrated once, see migrate().
+
+    Usage:
+        db = Database(om, 'sqldb')
+        with db.session() as session:
+            users = session.scalars(select(User)).all()
+
+    Args:
+        om (Omega): the omega instance
+        name (str): the name of the sqlalchemy dataset
+    """
+
+    def __init__(self, om, name):
+        self.om = om
+        self.name = name
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    # the connection is only used to get its engine, return it to the pool
+                    connection = self.om.datasets.get(self.name, raw=True)
+                    engine = connection.engine
+                    connection.close()
+                    migrate(engine)
+                    self._engine = engine
+        return self._engine
+
+    def warm(self):
+        # resolve the engine at app start, return True if available
+        try:
+            return self.engine is not None
+        except Exception:
+            logger.warning(f'could not connect to {self.name}, retrying on first use')
+            return False
+
+    def session(self):
+        return Session(self.engine)
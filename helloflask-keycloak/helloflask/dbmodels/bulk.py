@@ -0,0 +1,180 @@
+"""
+bulk import of users and their addresses
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from helloflask.dbmodels import Address, User
+
+
+def read_users(data, content_type='application/json'):
+    """ read a batch of users from json or csv
+
+    JSON is a list of users, or {'users': [...]}, each user a dict with the
+    keys id (optional), name, fullname and addresses, a list of email
+    addresses or of {'email_address': ...}. CSV has the columns id (optional),
+    name, fullname and addresses, the email addresses separated by ';'.
+
+    Args:
+        data (bytes|str): the json or csv document
+        content_type (str): the mimetype, text/csv for csv, else json
+
+    Returns:
+        the list of users, as dicts
+
+    Raises:
+        ValueError if the document cannot be read
+    """
+    data = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    if 'csv' in (content_type or ''):
+        users = []
+        for row in csv.DictReader(io.StringIO(data)):
+            user = {k: v or None for k, v in row.items() if k in ('id', 'name', 'fullname')}
+            if 'addresses' in row:
+                user['addresses'] = [a.strip() for a in (row['addresses'] or '').split(';') if a.strip()]
+            users.append(user)
+        return users
+    users = json.loads(data)
+    users = users.get('users') if isinstance(users, dict) else users
+    if not isinstance(users, list):
+        raise ValueError('expected a list of users, or {"users": [...]}')
+    return users
+
+
+def import_users(session, users, upsert=False, batch_size=1000):
+    """ insert or update a batch of users and their addresses
+
+    Users are written in batches of batch_size users, each user and address
+    batch by a single executemany insert, in the session's transaction. On
+    databases without INSERT..RETURNING, e.g. MySQL, users are inserted by
+    the ORM to get their ids, which is slower. The
+    caller commits. Invalid users are reported and skipped, i.e. they do not
+    abort the batch. If a batch fails in the database, e.g. for a duplicate
+    id, it is rolled back to a savepoint and written user by user, to report
+    the failing users.
+
+    Args:
+        session (Session): the session
+        users (list): the users, see read_users()
+        upsert (bool): if True, users whose id exists are updated, i.e. the
+           values given, e.g. fullname is kept if not given, and their addresses
+           replaced if given. Else they are reported as errors
+        batch_size (int): the number of users written at once
+
+    Returns:
+        dict(inserted=n, updated=n, errors=[{'row': i, 'error': message}]),
+        where row is the index of the user in users
+    """
+    result = {'inserted': 0, 'updated': 0, 'errors': []}
+    valid = []
+    for i, user in enumerate(users):
+        try:
+            valid.append((i, _validate(user)))
+        except ValueError as e:
+            result['errors'].append({'row': i, 'error': str(e)})
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        try:
+            with session.begin_nested():
+                inserted, updated = _write(session, [user for _, user in batch], upsert)
+        except SQLAlchemyError:
+            # find the failing users, write the others
+            inserted, updated = 0, 0
+            for i, user in batch:
+                try:
+                    with session.begin_nested():
+                        n_inserted, n_updated = _write(session, [user], upsert)
+                except SQLAlchemyError as e:
+                    result['errors'].append({'row': i, 'error': str(getattr(e, 'orig', None) or e).splitlines()[0]})
+                else:
+                    inserted, updated = inserted + n_inserted, updated + n_updated
+        result['inserted'] += inserted
+        result['updated'] += updated
+    result['errors'].sort(key=lambda error: error['row'])
+    return result
+
+
+def _validate(user):
+    # return the user's values, raise ValueError if invalid
+    if not isinstance(user, dict):
+        raise ValueError('a user must be an object')
+    name, fullname = user.get('name'), user.get('fullname')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    if len(name) > User.name.type.length:
+        raise ValueError(f'name must be at most {User.name.type.length} characters')
+    if fullname is not None and not isinstance(fullname, str):
+        raise ValueError('fullname must be a string')
+    # -- on upsert, only the given columns are updated
+    values = {'name': name, 'fullname': fullname} if 'fullname' in user else {'name': name}
+    if user.get('id') is not None:
+        try:
+            values['id'] = int(user['id'])
+        except (TypeError, ValueError):
+            raise ValueError(f'id must be an integer, got {user["id"]!r}')
+    if 'addresses' in user:
+        addresses = user['addresses'] or []
+        if not isinstance(addresses, list):
+            raise ValueError('addresses must be a list')
+        emails = [a.get('email_address') if isinstance(a, dict) else a for a in addresses]
+        if not all(isinstance(e, str) and e.strip() for e in emails):
+            raise ValueError('each address requires an email_address')
+        values['addresses'] = emails
+    return values
+
+
+def _write(session, users, upsert):
+    # write valid users, return (inserted, updated)
+    ids = [user['id'] for user in users if 'id' in user]
+    existing = set()
+    if upsert and ids:
+        existing = set(session.scalars(select(User.id).where(User.id.in_(ids))))
+    updates = [user for user in users if user.get('id') in existing]
+    addresses = []
+    if updates:
+        for group in _by_columns(updates):
+            session.execute(update(User), [_columns(user) for user in group])
+        replaced = [user['id'] for user in updates if 'addresses' in user]
+        if replaced:
+            session.execute(delete(Address).where(Address.user_id.in_(replaced)))
+        addresses += [(user['id'], user) for user in updates]
+    for inserts in _by_columns([user for user in users if user.get('id') not in existing]):
+        user_ids = _insert_users(session, [_columns(user) for user in inserts])
+        addresses += list(zip(user_ids, inserts))
+    rows = [{'user_id': user_id, 'email_address': email}
+            for user_id, user in addresses for email in user.get('addresses', [])]
+    if rows:
+        session.execute(insert(Address), rows)
+    return len(users) - len(updates), len(updates)
+
+
+def _insert_users(session, rows):
+    # insert users, return their ids in the order of rows
+    dialect = session.get_bind().dialect
+    if dialect.insert_executemany_returning_sort_by_parameter_order:
+        stmt = insert(User).returning(User.id, sort_by_parameter_order=True)
+        return session.scalars(stmt, rows).all()
+    # -- e.g. MySQL has no RETURNING, the ORM gets each user's id on flush
+    users = [User(**row) for row in rows]
+    session.add_all(users)
+    session.flush()
+    user_ids = [user.id for user in users]
+    for user in users:
+        session.expunge(user)
+    return user_ids
+
+
+def _columns(user):
+    return {k: v for k, v in user.items() if k != 'addresses'}
+
+
+def _by_columns(users):
+    # group users by their columns, e.g. with and without an id, each executemany has the same columns
+    groups = {}
+    for user in users:
+        groups.setdefault(tuple(sorted(_columns(user))), []).append(user)
+    return list(groups.values())
@@ -11,15 +11,19 @@ def local_init(server, app):
         'power-user': ['power-user', 'admin'],
         'user': ['user'],
     }
+    # -- sourceGroups as required by JWT_CLAIMS_RULES, see create_app()
     server.config['USER_CLAIMS'] = {
         'mike': {
             'groups': ['user'],
+            'sourceGroups': ['user'],
         },
         'eve': {
             'groups': ['power-user'],
+            'sourceGroups': ['user'],
         },
         'admin': {
             'groups': ['admin'],
+            'sourceGroups': ['user'],
         }
     }
 
@@ -1,11 +1,24 @@
+import atexit
+import getpass
+import hashlib
 import logging
+import mimetypes
 import os
-from flask import send_file
-from jinja2 import ChoiceLoader, FunctionLoader, PackageLoader
+import platform
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from logging.handlers import QueueHandler
+from time import monotonic
+
+from flask import Response, request
+from jinja2 import BytecodeCache, ChoiceLoader, FunctionLoader, PackageLoader
 
 from omegaml.client.userconf import get_omega_from_apikey
 from omegaml.store.logging import OmegaLoggingHandler
 
+logger = logging.getLogger(__name__)
 
 def load_om(context):
     """
@@ -24,8 +37,203 @@ def load_om(context):
     return om
 
 
+#: the hostname of log entries, as in omegaml.store.logging
+LOGGER_HOSTNAME = os.environ.get('HOSTNAME') or platform.node()
+
+#: a file loaded from om.datasets, see LiveFiles
+LiveFile = namedtuple('LiveFile', ['data', 'md5', 'mimetype', 'modified', 'version'])
+
+
+class LiveFiles:
+    """
+    An in-process cache of files stored in om.datasets
+
+    Files are cached in two tiers:
+
+    1. for ttl seconds after being loaded or revalidated, a file is served
+       from memory, without accessing om.datasets
+    2. after ttl seconds, the file's metadata is read and compared to the
+       cached version. The file's contents are only read again if the
+       file has changed
+
+    Names that do not exist in om.datasets are cached the same way, i.e. for
+    negative_ttl seconds get() returns None without accessing om.datasets.
+
+    At most max_entries files are cached, least recently used files are evicted
+    first. Files larger than max_file_size are not cached.
+
+    :param om: the omega instance
+    :param ttl: the seconds a file is served before revalidating, defaults to 5
+    :param negative_ttl: the seconds a missing file is assumed missing, defaults to ttl
+    :param max_entries: the maximum number of files cached, defaults to 1000
+    :param max_file_size: the maximum size of a file cached, in bytes, defaults to 10MB
+    """
+
+    def __init__(self, om, ttl=5, negative_ttl=None, max_entries=1000,
+                 max_file_size=10 * 1024 ** 2):
+        self.om = om
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        return the LiveFile for name, or None if it does not exist in om.datasets
+        """
+        with self._lock:
+            cached, checked = self._files.get(name, (None, None))
+            if checked is not None:
+                self._files.move_to_end(name)
+        ttl = self.ttl if cached is not None else self.negative_ttl
+        if checked is not None and monotonic() - checked < ttl:
+            return cached
+        meta = self.om.datasets.metadata(name)
+        version = file_version(meta)
+        if version is None:
+            cached = None
+        elif cached is None or cached.version != version:
+            cached = self._load(meta, version)
+        if cached is None or len(cached.data) <= self.max_file_size:
+            self._put(name, cached)
+        return cached
+
+    def invalidate(self, name=None):
+        """ forget a file, or all files """
+        with self._lock:
+            self._files.pop(name, None) if name else self._files.clear()
+
+    def _load(self, meta, version):
+        gridout = meta.gridfile.get()
+        try:
+            data = gridout.read()
+        finally:
+            gridout.close()
+        mimetype = mimetypes.guess_type(meta.name)[0] or 'application/octet-stream'
+        return LiveFile(data, hashlib.md5(data).hexdigest(), mimetype, meta.modified, version)
+
+    def _put(self, name, file):
+        with self._lock:
+            self._files[name] = (file, monotonic())
+            self._files.move_to_end(name)
+            while len(self._files) > self.max_entries:
+                self._files.popitem(last=False)
+
+
+class FileVersions:
+    """
+    The versions of all files in om.datasets under a path
+
+    The versions are read in one query, on first use, and refreshed every
+    interval seconds in the background. Use this to check if files exist or
+    have changed without accessing om.datasets, see file_version(). If
+    om.datasets is not available, no files exist until the versions can be
+    read, i.e. starting does not require om.datasets.
+
+    :param om: the omega instance
+    :param path: the path in om.datasets, e.g. 'files/templates'
+    :param interval: the seconds between refreshing the versions, defaults to 5
+    """
+
+    def __init__(self, om, path, interval=5):
+        self.om = om
+        self.path = path
+        self.interval = interval
+        self.versions = None
+        self._retry = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, name):
+        """ return the version of name, or None if it does not exist """
+        if self.versions is None:
+            self._load()
+        return (self.versions or {}).get(name)
+
+    def refresh(self):
+        metas = self.om.datasets.list('{}/*'.format(self.path), raw=True)
+        self.versions = {meta.name: file_version(meta) for meta in metas}
+        return self
+
+    def start(self):
+        """ refresh the versions in the background """
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._refresher, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresher(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                # keep the current versions, retry on the next interval
+                pass
+
+    def _load(self):
+        # read the versions on first use, retry after interval seconds if that fails
+        with self._lock:
+            if self.versions is not None or monotonic() < self._retry:
+                return
+            try:
+                self.refresh()
+            except Exception:
+                self._retry = monotonic() + self.interval
+                logger.exception(f'could not read the versions of {self.path}, retrying in {self.interval}s')
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """
+    A jinja bytecode cache in memory
+
+    Compiled templates are kept for as long as the template's source does
+    not change, up to max_entries templates.
+
+    :param max_entries: the maximum number of templates, defaults to 1000
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_bytecode(self, bucket):
+        with self._lock:
+            code = self._cache.get(bucket.key)
+        if code is not None:
+            # the bucket discards the code if the template's source has changed
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        with self._lock:
+            self._cache[bucket.key] = bucket.bytecode_to_string()
+            self._cache.move_to_end(bucket.key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+
+def file_version(meta):
+    """
+    the version of a file in om.datasets, or None if it does not exist
+
+    The version is the GridFS file id and the modification time, i.e. it
+    changes whenever the file is stored again.
+
+    :param meta: the file's Metadata, or None
+    """
+    if meta is None or not meta.gridfile:
+        return None
+    return str(meta.gridfile.grid_id), meta.modified
+
+
 def add_live_resources(om, app, base_path=None,
-                       static_folder=None):
+                       static_folder=None, ttl=5, negative_ttl=None):
     """
     Load static resources from files stored in om.datasets
 
@@ -42,27 +250,44 @@ def add_live_resources(om, app, base_path=None,
     The default <folder> is app.static_folder, defaults to 'static'
 
     Files are sent with a cache header according to Flask configuration
-    in SEND_FILE_MAX_AGE_DEFAULT.
+    in SEND_FILE_MAX_AGE_DEFAULT, and an ETag of the file's md5, i.e.
+    browsers can revalidate files without downloading them again.
 
-    Use this feature with caution as it may add to latency.
+    Files are cached in memory, see LiveFiles. Changes to files in om.datasets
+    are served after at most ttl seconds. Files that do not exist in om.datasets
+    are served from the local file system without accessing om.datasets, until
+    negative_ttl seconds have passed.
 
     :param om: the omega instance
     :param app: the blueprint
     :param base_path: the path in om.datasets to load files, defaults to 'files'
     :param static_folder: the static folder, defaults to 'static'
+    :param ttl: the seconds files are served from memory before revalidating,
+       defaults to 5
+    :param negative_ttl: the seconds files not in om.datasets are served from the
+       local file system before checking om.datasets again, defaults to ttl
     """
 
     base_path = base_path or 'files'
     static_folder = static_folder or os.path.basename(app.static_folder) or 'static'
+    live_files = LiveFiles(om, ttl=ttl, negative_ttl=negative_ttl)
 
     def _load_resources(filename):
         om_filename = os.path.join(base_path, static_folder, filename)
-        file = om.datasets.get(om_filename)
+        file = live_files.get(om_filename)
         if file is None:
             data = app.send_static_file(filename)
         else:
-            cache_timeout = app.get_send_file_max_age(filename)
-            data = send_file(file, mimetype='application/text', cache_timeout=cache_timeout)
+            data = Response(file.data, mimetype=file.mimetype)
+            data.set_etag(file.md5)
+            data.last_modified = file.modified
+            max_age = app.get_send_file_max_age(filename)
+            if max_age is not None:
+                data.cache_control.public = True
+                data.cache_control.max_age = max_age
+            else:
+                data.cache_control.no_cache = True
+            data = data.make_conditional(request)
         return data
 
     app.route('/resources/<path:filename>', endpoint='resources')(_load_resources)
@@ -70,7 +295,9 @@ def add_live_resources(om, app, base_path=None,
 
 def add_live_templates(om, server, app, base_path=None,
                        template_folder=None,
-                       cache_size=0):
+                       cache_size=0,
+                       refresh_interval=5,
+                       bytecode_cache=True):
     """
     Load templates from files stored in om.datasets
 
@@ -90,7 +317,12 @@ def add_live_templates(om, server, app, base_path=None,
 
     The default <folder> is app.template_folder (defaults to 'templates')
 
-    Use this feature with caution as it may add to latency.
+    The versions of all templates in om.datasets are read in one query, and
+    refreshed every refresh_interval seconds in the background, see
+    FileVersions. Checking if a template exists or has changed does not access
+    om.datasets, and a template's source is only read from om.datasets when it
+    has changed. Changes to templates are rendered after at most
+    refresh_interval seconds.
 
     :param om: the omega instance
     :param server: the Flask instance
@@ -101,34 +333,45 @@ def add_live_templates(om, server, app, base_path=None,
        causing recompiling of templates on every access. Set this to a larger
        value to only recompile templates when changed. Note for live loading
        to work with a cache size other than 0, the template must exist in
-       om.datasets at the time of application start. If it does not exist and
+       om.datasets at the time it is first loaded. If it does not exist and
        the cache size is not 0, Flask will load the packaged template and keep
        this in its cache. With a cache size other than 0, templates are only
        recompiled if the file has actually changed. See jina docs for details.
+    :param refresh_interval: the seconds between refreshing the versions of
+       templates in om.datasets, defaults to 5
+    :param bytecode_cache: if True, compiled templates are kept in memory, see
+       MemoryBytecodeCache, i.e. templates are not recompiled on every access
+       even if cache_size is 0. Defaults to True
     """
 
     base_path = base_path or 'files'
     template_folder = template_folder or os.path.basename(app.template_folder) or 'templates'
+    versions = FileVersions(om, '{}/{}'.format(base_path, template_folder),
+                            interval=refresh_interval).start()
+    # om_filename => (version, source)
+    sources = {}
 
     def load_live_template(filename):
         om_filename = '{}/{}/{}'.format(base_path,
                                         template_folder,
                                         filename)
-        data = None
-        file = om.datasets.get(om_filename)
-
-        if file is not None:
-            loaded_md5 = getattr(file, 'md5', None)
-
-            def uptodatefn():
-                file = om.datasets.get(om_filename)
-                live_md5 = getattr(file, 'md5', None)
-                return live_md5 == loaded_md5
-
+        loaded_version = versions.get(om_filename)
+        if loaded_version is None:
+            # not in om.datasets, use the packaged template
+            return None
+        version, source = sources.get(om_filename, (None, None))
+        if version != loaded_version:
+            file = om.datasets.get(om_filename)
+            if file is None:
+                return None
             source = file.read().decode('utf8')
-            data = source, om_filename, uptodatefn
             file.close()
-        return data
+            sources[om_filename] = loaded_version, source
+
+        def uptodatefn():
+            return versions.get(om_filename) == loaded_version
+
+        return source, om_filename, uptodatefn
 
     server.jinja_loader = ChoiceLoader([
         FunctionLoader(load_live_template),
@@ -136,9 +379,122 @@ def add_live_templates(om, server, app, base_path=None,
         PackageLoader(app.name),
     ])
     server.jinja_options.update(cache_size=cache_size)
+    if bytecode_cache:
+        server.jinja_options.update(bytecode_cache=MemoryBytecodeCache())
 
 
-def add_omega_logger(om, server):
+class BatchingQueueHandler(QueueHandler):
+    """
+    A non-blocking logging handler that ships records in batches
+
+    Records are put on a bounded queue and written to the omega log dataset
+    by a background thread, in batches of up to batch_size records, at least
+    every flush_interval seconds. Logging thus never waits for the store.
+
+    If the queue is full, records below keep_level are dropped, and records at
+    or above keep_level replace the oldest queued record. The number of
+    dropped records is logged with the next batch. Queued records are written
+    on shutdown, see stop().
+
+    :param handler: the OmegaLoggingHandler, used to format records and to
+       write to its collection
+    :param maxsize: the maximum number of queued records, defaults to 10000
+    :param batch_size: the maximum number of records written at once, defaults to 500
+    :param flush_interval: the seconds between writes, defaults to 1
+    :param keep_level: the level of records never dropped for newer records,
+       defaults to WARNING
+    """
+
+    def __init__(self, handler, maxsize=10000, batch_size=500, flush_interval=1.0,
+                 keep_level=logging.WARNING):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keep_level = keep_level
+        self.dropped = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._ship, daemon=True, name='omega-logger')
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def enqueue(self, record):
+        if threading.current_thread() is self._thread:
+            # don't log the store's own logging while shipping, it would never end
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < self.keep_level:
+                self.dropped += 1
+                return
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                self.dropped += 1
+
+    def flush(self):
+        """ write all queued records now """
+        self._write(self._drain(self.queue.qsize()))
+
+    def stop(self, timeout=5):
+        """ stop the background thread, after writing all queued records """
+        if not self._stop.is_set():
+            self._stop.set()
+            self._thread.join(timeout)
+
+    def _ship(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            self._write(batch + self._drain(self.batch_size - len(batch)))
+        # flush on shutdown
+        while not self.queue.empty():
+            self._write(self._drain(self.batch_size))
+
+    def _drain(self, n):
+        records = []
+        for _ in range(n):
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _write(self, records):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'logging queue full, dropped {} records'.format(dropped)}))
+        if not records:
+            return
+        # -- the same entries as OmegaLoggingHandler.emit(), as read by om.logger
+        userid = getattr(self.handler, 'userid', None) or getpass.getuser()
+        entries = [{
+            'level': record.levelname,
+            'levelno': record.levelno,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'text': self.handler.format(record),
+            'hostname': getattr(record, 'hostname', LOGGER_HOSTNAME),
+            'created': datetime.utcfromtimestamp(record.created),
+            'userid': str(userid),
+        } for record in records]
+        try:
+            self.handler.collection.insert_many(entries, ordered=False)
+        except Exception:
+            # the records are lost, logging must not fail the app
+            self.failed += len(entries)
+
+
+def add_omega_logger(om, server, level='DEBUG', maxsize=10000, batch_size=500,
+                     flush_interval=1.0):
     """
     route Flask logging output to om.logger
 
@@ -146,8 +502,24 @@ def add_omega_logger(om, server):
 
     $ om runtime log -f
 
+    Log records are written in batches by a background thread, see
+    BatchingQueueHandler, i.e. logging does not add latency to requests.
+    If the log store is slow, up to maxsize records are queued, then less
+    important records are dropped.
+
     :param om: the omega instance
     :param server: the Flask instance
+    :param level: the log level, defaults to DEBUG
+    :param maxsize: the maximum number of queued records, defaults to 10000
+    :param batch_size: the maximum number of records written at once, defaults to 500
+    :param flush_interval: the seconds between writes, defaults to 1
+    :return: the BatchingQueueHandler
     """
-    handler = OmegaLoggingHandler.setup(logger=logging.getLogger('root'), level='DEBUG')
+    # the omega handler is not attached to a logger, it is only used by the queue handler
+    omega_handler = OmegaLoggingHandler.setup(store=om.datasets, logger=logging.Logger(__name__),
+                                              level=level)
+    handler = BatchingQueueHandler(omega_handler, maxsize=maxsize, batch_size=batch_size,
+                                   flush_interval=flush_interval)
+    handler.setLevel(level)
     [logging.getLogger(l).addHandler(handler) for l in ('werkzeug', 'flask.app', server.name)]
+    return handler
@@ -0,0 +1,223 @@
+"""
+throughput and latency benchmark for the streaming app
+
+Purpose:
+    measure what the consumer in streaming/app.py can sustain, and catch
+    regressions when changing the window function or the sink
+
+What it does:
+    1. starts the consumer in a separate process, the same way the
+       StreamingApp does, writing to a new stream and dataset
+    2. appends N synthetic messages to the stream, at a given rate, using
+       minibatch.stream(...).append()
+    3. polls the dataset for the windows stored by the consumer, until all
+       messages are visible or the timeout has passed
+    4. stops the consumer and drops the dataset
+    5. writes the results as json
+
+Results:
+    messages     - sent, received, and the rates in messages/sec
+    latency      - seconds from append() to visible in the dataset,
+                   min, mean, p50, p95, p99, max
+    windows      - number of windows and their size (messages per window)
+    executor     - busy seconds of the processing function, and utilization,
+                   i.e. busy seconds / (elapsed seconds * workers)
+
+    Note latency includes up to --poll seconds of polling delay.
+
+Usage:
+    # run omegaml locally (specify [mongodb] without brackets for a minimum setup)
+    $ docker-compose -f omegaml/docker-compose.yml up [mongodb]
+
+    # in the streaming directory
+    $ python benchmark.py --messages 10000 --rate 2000 --output bench.json
+
+    # compare runs with a different window function
+    $ python benchmark.py --window-size 100 --output bench-size100.json
+
+    See python benchmark.py --help for all options
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from multiprocessing import Process
+from time import sleep, time
+
+
+class TimedProcessing:
+    """
+    wrap the processing function to record its busy time per window
+
+    Each executor process appends 'pid start end' lines to a file in logdir,
+    so that no communication between processes is required.
+    """
+
+    def __init__(self, processfn, logdir):
+        self.processfn = processfn
+        self.logdir = logdir
+
+    def __call__(self, window):
+        start = time()
+        try:
+            return self.processfn(window)
+        finally:
+            fn = os.path.join(self.logdir, 'worker-{}.log'.format(os.getpid()))
+            with open(fn, 'a') as fout:
+                fout.write('{} {} {}\n'.format(os.getpid(), start, time()))
+
+
+def produce(stream, messages, rate, payload, sent, done):
+    # append messages at the given rate, 0 means as fast as possible
+    start = time()
+    for i in range(messages):
+        if done.is_set():
+            break
+        if rate:
+            delay = start + i / rate - time()
+            sleep(delay) if delay > 0 else None
+        stream.append({'seq': i, 'ts': time(), 'payload': payload})
+        sent.append(time())
+
+
+def observe(collection, messages, timeout, poll, done):
+    # poll the dataset until all messages are visible or timeout
+    from streaming.reader import read_since
+
+    latencies, windows = [], []
+    since, deadline = None, time() + timeout
+    while len(latencies) < messages and time() < deadline and not done.is_set():
+        for doc in read_since(collection, since=since, limit=0):
+            seen = time()
+            since = doc['id']
+            windows.append(len(doc['data']))
+            latencies.extend(seen - record['ts'] for record in doc['data'])
+        sleep(poll)
+    return latencies, windows
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summary(values):
+    if not values:
+        return {}
+    return {
+        'min': min(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def executor_stats(logdir, elapsed, workers):
+    spans = []
+    for fn in os.listdir(logdir):
+        with open(os.path.join(logdir, fn)) as fin:
+            spans.extend(tuple(float(v) for v in line.split()) for line in fin)
+    busy = sum(end - start for pid, start, end in spans)
+    pids = {pid for pid, start, end in spans}
+    return {
+        'workers': workers,
+        'workers_seen': len(pids),
+        'calls': len(spans),
+        'busy_seconds': busy,
+        'utilization': busy / (elapsed * workers) if elapsed else None,
+        'seconds_per_call': summary([end - start for pid, start, end in spans]),
+    }
+
+
+def run(url=None, messages=10000, rate=0, payload_size=100, window_size=None,
+        interval=None, workers=None, max_records=5000, max_latency=1.0,
+        timeout=120, poll=.01):
+    import minibatch as mb
+    import omegaml as om
+    from streaming.app import consumer, process_window
+
+    url = url or mb.authenticated_url(om.defaults.OMEGA_MONGO_URL)
+    run_id = uuid.uuid4().hex[:8]
+    stream_name, dataset = 'bench-{}'.format(run_id), 'bench-{}-stream'.format(run_id)
+    workers = workers or os.cpu_count()
+    stream_kwargs = {k: v for k, v in dict(size=window_size, interval=interval).items() if v}
+    logdir = tempfile.mkdtemp(prefix='bench-')
+    proc = Process(target=consumer, kwargs=dict(url=url, stream=stream_name, dataset=dataset,
+                                                processfn=TimedProcessing(process_window, logdir),
+                                                sink_kwargs=dict(max_records=max_records,
+                                                                 max_latency=max_latency),
+                                                max_workers=workers, **stream_kwargs))
+    proc.start()
+    stream = mb.stream(stream_name, url=url)
+    sent, done = [], threading.Event()
+    producer = threading.Thread(target=produce,
+                                args=(stream, messages, rate, 'x' * payload_size, sent, done))
+    start = time()
+    producer.start()
+    try:
+        latencies, windows = observe(om.datasets.collection(dataset), messages, timeout, poll, done)
+        elapsed = time() - start
+    finally:
+        done.set()
+        producer.join()
+        proc.terminate()
+        proc.join()
+        om.datasets.drop(dataset, force=True)
+    return {
+        'run_id': run_id,
+        'created': datetime.utcnow().isoformat(),
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'cpus': os.cpu_count()},
+        'parameters': {'messages': messages, 'rate': rate, 'payload_size': payload_size,
+                       'window_size': window_size, 'interval': interval, 'workers': workers,
+                       'max_records': max_records, 'max_latency': max_latency,
+                       'timeout': timeout, 'poll': poll},
+        'messages': {
+            'sent': len(sent),
+            'received': len(latencies),
+            'elapsed_seconds': elapsed,
+            'append_rate': len(sent) / (sent[-1] - start) if len(sent) > 1 else None,
+            'throughput': len(latencies) / elapsed if elapsed else None,
+        },
+        'latency': summary(latencies),
+        'windows': dict(count=len(windows), size=summary(windows)),
+        'executor': executor_stats(logdir, elapsed, workers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='streaming app benchmark')
+    parser.add_argument('--url', help='the minibatch mongo url, defaults to om.defaults.OMEGA_MONGO_URL')
+    parser.add_argument('--messages', type=int, default=10000, help='number of messages to send')
+    parser.add_argument('--rate', type=float, default=0, help='messages/sec, 0 sends as fast as possible')
+    parser.add_argument('--payload-size', type=int, default=100, help='bytes of payload per message')
+    parser.add_argument('--window-size', type=int, help='@streaming(size=), messages per window')
+    parser.add_argument('--interval', type=float, help='@streaming(interval=), seconds per window')
+    parser.add_argument('--workers', type=int, help='executor processes, defaults to cpu count')
+    parser.add_argument('--max-records', type=int, default=5000, help='sink flush size, in messages')
+    parser.add_argument('--max-latency', type=float, default=1.0, help='sink flush latency, in seconds')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for all messages')
+    parser.add_argument('--poll', type=float, default=.01, help='dataset polling interval, in seconds')
+    parser.add_argument('--output', help='the json file to write, defaults to stdout')
+    args = parser.parse_args()
+    options = vars(args)
+    output = options.pop('output')
+    results = run(**options)
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as fout:
+            fout.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
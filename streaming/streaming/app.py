@@ -19,6 +19,14 @@ Usage:
     # see the data flowing in by refreshing on
     http://localhost:5000/
 
+    # or poll for the windows appended since the last response
+    http://localhost:5000/?since=<id|timestamp>&limit=100
+    http://localhost:5000/?since=<id|timestamp>&format=ndjson
+
+    # or have new windows pushed as they are stored
+    http://localhost:5000/events (server-sent events)
+    http://localhost:5000/poll?since=<id> (long-poll)
+
     Note the same works regardless of the actual location of the streaming/app.py
     and the producer session, as long as both are connected to the same omega|ml
     server. We can of course make the producer independent of an omega|ml connection
@@ -39,16 +47,42 @@ Usage:
     # run omegaml locally (specify [mongodb] without brackets for a minimum setup)
     $ docker-compose -f omegaml/docker-compose.yml up [mongodb]
 """
-from minibatch.contrib.apps.omegaml import StreamingApp
+from streaming.push import PushStreamingApp
+
+#: the maximum number of windows returned in one json response
+MAX_PAGE_SIZE = 10000
+
 
 def create_app(context=None, server=None, uri=None, **kwargs):
-    app = StreamingApp(server=server, uri=uri)
+    # serves /events and /poll, pushing every window stored in test-stream
+    app = PushStreamingApp(server=server, uri=uri, dataset='test-stream')
 
     # add any routes you like, will be served at <uri>/<route>
     @app.route('/')
     def index():
+        # return the windows appended since the client's last poll
+        # -- ?since=<id|timestamp> the cursor, i.e. the last id received
+        # -- ?limit=N the maximum number of windows, defaults to 100
+        # -- ?format=ndjson streams one window per line, limit=0 streams all
         import omegaml as om
-        return '{}'.format(om.datasets.get('test-stream'))
+        from flask import Response, abort, request
+        from streaming.reader import as_ndjson, read_since
+
+        since = request.args.get('since')
+        limit = request.args.get('limit', 100, type=int)
+        stream = (request.args.get('format') == 'ndjson' or
+                  request.accept_mimetypes.best == 'application/x-ndjson')
+        collection = om.datasets.collection('test-stream')
+        try:
+            if stream:
+                docs = read_since(collection, since=since, limit=limit)
+                return Response(as_ndjson(docs), mimetype='application/x-ndjson')
+            limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+            docs = list(read_since(collection, since=since, limit=limit))
+        except ValueError as e:
+            abort(400, 'invalid since={}: {}'.format(since, e))
+        cursor = docs[-1]['id'] if docs else since
+        return {'data': docs, 'cursor': cursor}
 
     # if you added routes, register the blueprint
     app.server.register_blueprint(app)
@@ -58,17 +92,37 @@ def create_app(context=None, server=None, uri=None, **kwargs):
     return app
 
 
-def consumer(url=None):
+def consumer(url=None, stream='test', dataset='test-stream', processfn=None,
+             sink_kwargs=None, **kwargs):
     # this is the consumer implementation, i.e. the @streaming function
+    # -- stream, dataset, processfn and kwargs (passed to @streaming) can be
+    #    changed for testing, see benchmark.py
+    import signal
+    from queue import Queue
     from minibatch import streaming
+    from streaming.sink import BufferedSink
+
+    processfn = processfn or process_window
+    # the sink coalesces windows and writes them to the dataset in bulk
+    # -- it runs in this process, the processing function's result is forwarded to it
+    sink = BufferedSink(dataset, **(sink_kwargs or {}))
+    # app.stop() terminates this process, stop the emitter so the sink can be flushed
+    stop = Queue()
+    signal.signal(signal.SIGTERM, lambda *args: stop.put(True))
 
     # you may add a source or just rely on some producer to write to the stream
-    # may also add a sink if you like or just store the data somehow else
     # note that the @streaming processing function is run in parallel on an executor pool of processes
-    @streaming('test', url=url)
+    @streaming(stream, url=url, sink=sink, queue=stop, **kwargs)
     def processing(window):
-        import omegaml as om
-        om.datasets.put(window.data, 'test-stream')
+        return processfn(window)
+
+    # the emitter has stopped and all pending windows have been forwarded
+    sink.close()
+
+
+def process_window(window):
+    # process the window's data, the result is stored by the sink
+    return window.data
 
 
 if __name__ == '__main__':
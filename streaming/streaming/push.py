@@ -0,0 +1,278 @@
+"""
+push processed windows to connected clients
+
+Purpose:
+    send every window stored by the consumer to all connected clients, using
+    server-sent events (SSE) or long-polling, instead of each client
+    re-querying the dataset on every refresh
+
+How it works:
+    The consumer runs in a separate process, so the web process cannot see
+    windows as they are processed. Instead, a single DatasetFeed thread per
+    web process reads the windows appended to the dataset (see
+    streaming.reader) and publishes them to a Broadcaster. The Broadcaster
+    fans out each window to all subscribers. Thus the number of database
+    reads is independent of the number of connected clients.
+
+    Each SSE client has a bounded buffer of frames. If a client does not keep
+    up, the oldest frames are dropped. Long-poll clients are served from a
+    bounded history of recent frames.
+"""
+import json
+import logging
+import threading
+from collections import deque
+from time import monotonic
+
+from minibatch.contrib.apps.omegaml import StreamingApp
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    """
+    a bounded buffer of frames for one client, dropping the oldest frames
+    """
+
+    def __init__(self, maxsize=100):
+        self.frames = deque(maxlen=maxsize)
+        self.dropped = 0
+        self._cond = threading.Condition()
+
+    def put(self, frame):
+        with self._cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ return all buffered frames, wait up to timeout seconds if there are none """
+        with self._cond:
+            if not self.frames:
+                self._cond.wait(timeout)
+            frames = list(self.frames)
+            self.frames.clear()
+        return frames
+
+
+class Broadcaster:
+    """
+    fan out frames to all subscribers
+
+    Args:
+        maxsize (int): the default size of each subscriber's buffer
+        history (int): the number of recent frames kept for long-polling
+    """
+
+    def __init__(self, maxsize=100, history=1000):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.history = deque(maxlen=history)
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def subscribe(self, maxsize=None):
+        subscriber = Subscriber(maxsize=maxsize or self.maxsize)
+        with self._lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, frame):
+        """ send a frame, i.e. a dict(id=, data=), to all subscribers """
+        with self._cond:
+            self.history.append(frame)
+            subscribers = list(self.subscribers)
+            self._cond.notify_all()
+        for subscriber in subscribers:
+            subscriber.put(frame)
+
+    def wait_since(self, since=None, timeout=None):
+        """ return the frames published after since, wait if there are none
+
+        Args:
+            since (str): the id of the last frame the client has seen, if None
+               waits for the next frame
+            timeout (float): the maximum number of seconds to wait
+
+        Returns:
+            list of frames, empty if there are no new frames within timeout
+        """
+        with self._cond:
+            last = since or (self.history[-1]['id'] if self.history else '')
+            # ids are ObjectId hex strings, which sort by time of insertion
+            newer = lambda: [f for f in self.history if f['id'] > last]  # noqa
+            self._waiting += 1
+            try:
+                self._cond.wait_for(newer, timeout)
+            finally:
+                self._waiting -= 1
+            return newer()
+
+    @property
+    def has_listeners(self):
+        return bool(self.subscribers or self._waiting)
+
+
+class DatasetFeed(threading.Thread):
+    """
+    publish windows appended to a dataset to a Broadcaster
+
+    Polls the dataset every interval seconds, only while there are clients
+    listening. Short gaps between clients, e.g. in between long-polls, are
+    caught up on. After more than idle seconds without any clients, it
+    continues from the latest window, i.e. older windows are not replayed.
+
+    Args:
+        broadcaster (Broadcaster): the broadcaster to publish to
+        dataset (str): the name of the dataset in om.datasets
+        interval (float): the polling interval in seconds
+        idle (float): the seconds without clients after which to stop catching up
+        om (Omega): the omega instance, defaults to import omegaml as om
+    """
+
+    def __init__(self, broadcaster, dataset, interval=.5, idle=60, om=None):
+        super().__init__(daemon=True)
+        self.broadcaster = broadcaster
+        self.dataset = dataset
+        self.interval = interval
+        self.idle = idle
+        self._om = om
+        self._stopped = threading.Event()
+
+    @property
+    def om(self):
+        if self._om is None:
+            import omegaml as om
+            self._om = om
+        return self._om
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        from streaming.reader import read_since
+
+        since = None
+        idle_since = monotonic()
+        while not self._stopped.wait(self.interval):
+            if not self.broadcaster.has_listeners:
+                if monotonic() - idle_since > self.idle:
+                    since = None
+                continue
+            idle_since = monotonic()
+            try:
+                collection = self.om.datasets.collection(self.dataset)
+                since = since or self._latest_id(collection)
+                for frame in read_since(collection, since=since, limit=0):
+                    self.broadcaster.publish(frame)
+                    since = frame['id']
+            except Exception as e:
+                logger.error('could not read {}: {}'.format(self.dataset, e))
+
+    def _latest_id(self, collection):
+        latest = collection.find_one({}, projection={'_id': 1}, sort=[('_id', -1)])
+        return str(latest['_id']) if latest else '0' * 24
+
+
+class PushStreamingApp(StreamingApp):
+    """
+    a StreamingApp that pushes each stored window to connected clients
+
+    Adds the following routes:
+
+        /events - server-sent events, one event per window
+        /poll   - long-poll fallback, /poll?since=<id>&timeout=<seconds>,
+                  returns dict(data=[frames], cursor=<id>)
+
+    Each frame is a dict(id=, data=), where id is the window's id in the
+    dataset (see streaming.reader) and data is the window's data.
+
+    Usage:
+        app = PushStreamingApp(server=server, uri=uri, dataset='test-stream')
+
+        # in the browser
+        const events = new EventSource('<uri>/events');
+        events.onmessage = (e) => console.log(JSON.parse(e.data));
+
+    Args:
+        dataset (str): the name of the dataset the consumer writes to
+        maxsize (int): the size of each SSE client's buffer, in frames
+        history (int): the number of frames kept for long-poll clients
+        interval (float): the dataset polling interval, in seconds
+        keepalive (float): the seconds between SSE keep-alive comments
+    """
+
+    def __init__(self, *args, dataset=None, maxsize=100, history=1000,
+                 interval=.5, keepalive=15, **kwargs):
+        self.broadcaster = Broadcaster(maxsize=maxsize, history=history)
+        self.feed = DatasetFeed(self.broadcaster, dataset, interval=interval)
+        self.keepalive = keepalive
+        super().__init__(*args, **kwargs)
+
+    def register_routes(self, app):
+        from flask import Response, request
+
+        super().register_routes(app)
+
+        @app.route('/events')
+        def streaming_app_events():
+            self._start_feed()
+            subscriber = self.broadcaster.subscribe()
+            last_id = request.headers.get('Last-Event-ID')
+            missed = self.broadcaster.wait_since(last_id, timeout=0) if last_id else []
+
+            def generate():
+                # frames published since subscribing are both replayed and buffered by
+                # the subscriber, skip those already sent. Ids sort by time, see wait_since()
+                sent, frames = last_id or '', missed
+                try:
+                    # WSGI servers send the headers with the first chunk
+                    yield ': connected\n\n'
+                    while True:
+                        for frame in frames:
+                            if frame['id'] > sent:
+                                sent = frame['id']
+                                yield sse_event(frame)
+                        frames = subscriber.get(timeout=self.keepalive)
+                        if not frames:
+                            yield ': keep-alive\n\n'
+                finally:
+                    self.broadcaster.unsubscribe(subscriber)
+
+            headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+        @app.route('/poll')
+        def streaming_app_poll():
+            self._start_feed()
+            since = request.args.get('since')
+            timeout = min(request.args.get('timeout', 25, type=float), 60)
+            frames = self.broadcaster.wait_since(since, timeout=timeout)
+            cursor = frames[-1]['id'] if frames else since
+            return {'data': frames, 'cursor': cursor}
+
+    def _start_feed(self):
+        if not self.feed.is_alive() and self.feed.ident is None:
+            try:
+                self.feed.start()
+            except RuntimeError:
+                # started concurrently by another request
+                pass
+
+    def _stop_consumer(self):
+        self.feed.stop()
+        super()._stop_consumer()
+
+    stop = _stop_consumer
+    stop_streaming = _stop_consumer
+
+
+def sse_event(frame):
+    """ format a frame as a server-sent event """
+    return 'id: {}\ndata: {}\n\n'.format(frame['id'], json.dumps(frame['data'], default=str))
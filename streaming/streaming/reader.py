@@ -0,0 +1,81 @@
+"""
+incremental, cursor-based reads of a streaming dataset
+
+Purpose:
+    read only the windows appended since a client's last poll, instead of
+    loading the full dataset on every request
+
+How it works:
+    Every window is stored as one document in the dataset's collection (see
+    streaming.sink). Documents are read in the order of their _id, which is
+    an ObjectId and thus increasing by insertion time. The _id is always
+    indexed by MongoDB, so each page is an index range scan, regardless of
+    the size of the dataset.
+
+    A cursor is either the id of the last document returned, or a timestamp
+    (ISO 8601 or seconds since epoch, UTC). Since ObjectIds encode the time of
+    insertion, a timestamp is converted to the lowest ObjectId of that second.
+"""
+import calendar
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+
+def parse_cursor(since):
+    """ parse a cursor value into a mongodb _id filter
+
+    Args:
+        since (str): an ObjectId, ISO 8601 timestamp or seconds since epoch
+
+    Returns:
+        the filter dict, empty if since is None or empty
+
+    Raises:
+        ValueError if since cannot be parsed, or is before 1970 or after 2106
+    """
+    if not since:
+        return {}
+    if ObjectId.is_valid(since):
+        return {'_id': {'$gt': ObjectId(since)}}
+    try:
+        dt = datetime.fromtimestamp(float(since), tz=timezone.utc)
+    except ValueError:
+        dt = datetime.fromisoformat(since)
+    except (OverflowError, OSError) as e:
+        raise ValueError('timestamp out of range: {}'.format(e))
+    # ObjectIds store the seconds since epoch as an unsigned 32-bit integer,
+    # naive datetimes are in UTC, as in ObjectId.from_datetime()
+    try:
+        seconds = calendar.timegm(dt.utctimetuple())
+    except OverflowError as e:
+        raise ValueError('timestamp out of range: {}'.format(e))
+    if not 0 <= seconds < 2 ** 32:
+        raise ValueError('timestamp out of range: {}'.format(dt.isoformat()))
+    return {'_id': {'$gte': ObjectId.from_datetime(dt)}}
+
+
+def read_since(collection, since=None, limit=100):
+    """ return the documents appended since the cursor, oldest first
+
+    Args:
+        collection (Collection): the dataset's collection,
+           i.e. om.datasets.collection(name)
+        since (str): the cursor, see parse_cursor()
+        limit (int): the maximum number of documents, 0 means no limit
+
+    Returns:
+        generator of dict(id=str, data=list)
+    """
+    cursor = (collection
+              .find(parse_cursor(since), projection={'data': 1})
+              .sort('_id', 1)
+              .limit(limit or 0))
+    return ({'id': str(doc['_id']), 'data': doc.get('data')} for doc in cursor)
+
+
+def as_ndjson(docs):
+    """ yield newline-delimited json, one line per document """
+    for doc in docs:
+        yield json.dumps(doc, default=str) + '\n'
@@ -0,0 +1,148 @@
+"""
+a buffered, append-only sink for minibatch windows
+
+Purpose:
+    coalesce many small windows into one bulk insert into an omegaml dataset,
+    instead of one om.datasets.put() per window
+"""
+import logging
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedSink:
+    """
+    coalesce streaming windows into bulk inserts to an omegaml dataset
+
+    Each window's data is added to an in-memory buffer. The buffer is written
+    to the dataset in one bulk insert as soon as any of these limits is reached:
+
+        max_records - the number of messages buffered, across all windows
+        max_bytes   - the approximate size of the messages buffered
+        max_latency - the seconds since the oldest buffered window was added
+
+    Every window is stored as one document, the same as om.datasets.put(list)
+    does, so that om.datasets.get(name) returns the same data as before.
+
+    Usage:
+        def consumer(url=None):
+            sink = BufferedSink('test-stream')
+
+            @streaming('test', url=url, sink=sink)
+            def processing(window):
+                return window.data
+
+            # once the streaming function returns
+            sink.close()
+
+    Notes:
+        * minibatch calls sink.put() in the consumer process with the result of
+          the processing function, i.e. there is exactly one writer regardless
+          of the number of processes in the executor pool
+        * the byte size is estimated as len(repr(data)). This is cheap and good
+          enough to decide when to flush, it is not the actual BSON size
+        * if a bulk insert fails, the windows are kept in the buffer and written
+          on the next flush
+    """
+
+    def __init__(self, name, om=None, max_records=5000, max_bytes=4 * 1024 ** 2,
+                 max_latency=1.0):
+        self.name = name
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self._om = om
+        self._lock = threading.RLock()
+        self._windows = []
+        self._records = 0
+        self._bytes = 0
+        self._since = None
+        self._stop = threading.Event()
+        self._flusher = None
+
+    @property
+    def om(self):
+        if self._om is None:
+            import omegaml as om
+            self._om = om
+        return self._om
+
+    def put(self, data):
+        """ add a window's data to the buffer, flush if any limit is reached """
+        if not data:
+            return
+        with self._lock:
+            self._windows.append(list(data))
+            self._records += len(data)
+            self._bytes += len(repr(data))
+            self._since = self._since or monotonic()
+            is_full = (self._records >= self.max_records or
+                       self._bytes >= self.max_bytes)
+        self._start_flusher()
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        """ write all buffered windows in one bulk insert
+
+        Returns:
+            the number of windows written
+        """
+        with self._lock:
+            windows = self._windows
+            if not windows:
+                return 0
+            self._windows, self._records, self._bytes, self._since = [], 0, 0, None
+            try:
+                self._write(windows)
+            except Exception:
+                # keep the data for the next flush, in order
+                for window in reversed(windows):
+                    self._restore(window)
+                raise
+        return len(windows)
+
+    def close(self):
+        """ stop the background flusher and write any remaining data """
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        return self.flush()
+
+    def _restore(self, window):
+        self._windows.insert(0, window)
+        self._records += len(window)
+        self._bytes += len(repr(window))
+        self._since = self._since or monotonic()
+
+    def _write(self, windows):
+        store = self.om.datasets
+        if store.metadata(self.name) is None:
+            # the first write creates the dataset's metadata
+            store.put(windows[0], self.name)
+            windows = windows[1:]
+        if windows:
+            collection = store.collection(self.name)
+            collection.insert_many([{'data': data} for data in windows])
+
+    def _start_flusher(self):
+        if self._flusher is not None or self._stop.is_set():
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_on_latency,
+                                                 daemon=True)
+                self._flusher.start()
+
+    def _flush_on_latency(self):
+        while not self._stop.wait(self.max_latency / 2):
+            since = self._since
+            if since is None or monotonic() - since < self.max_latency:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('could not write to {}: {}'.format(self.name, e))